@@ -0,0 +1,127 @@
+"""
+Local stand-in for the Telegram Bot API: the methods Polybot calls, and file downloads of generated photos.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import cv2
+import numpy as np
+
+
+def make_photo(width=1280, height=960, seed=0):
+    """A random JPEG, different for every seed so the photos don't hit the result cache"""
+    rng = np.random.default_rng(seed)
+    # Smooth noise compresses like a real photo, white noise would be several times larger
+    small = rng.integers(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+    image = cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
+    return cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+
+class FakeTelegram:
+    """
+    Serves /bot<token>/<method> and /file/bot<token>/<path> on 127.0.0.1. Every file_id is a photo,
+    generated on first download and kept. Sent messages are recorded with their timestamp.
+    """
+
+    def __init__(self, photo_width=1280, photo_height=960, latency=0.0):
+        self.photo_width = photo_width
+        self.photo_height = photo_height
+        self.latency = latency  # added to every API call, as a round trip to api.telegram.org would be
+        self.messages = []  # (timestamp, chat_id, text)
+        self.files = {}
+        self.webhook_url = ''
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        telegram = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._handle(parse_qs(self.path.partition('?')[2]))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                # telebot sends the parameters in the query string, and files (the certificate) as multipart
+                params = parse_qs(self.path.partition('?')[2])
+                if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                    params.update(parse_qs(body.decode()))
+                elif self.headers.get('Content-Type', '').startswith('application/json'):
+                    params.update({key: [value] for key, value in json.loads(body or b'{}').items()})
+                self._handle(params)
+
+            def _handle(self, params):
+                path = self.path.partition('?')[0]
+                params = {key: values[0] for key, values in params.items()}
+                if path.startswith('/file/'):
+                    status, content_type, data = 200, 'image/jpeg', telegram.file(path.rsplit('/', 1)[-1])
+                else:
+                    result = telegram.call(path.rsplit('/', 1)[-1], params)
+                    status, content_type = 200, 'application/json'
+                    data = json.dumps({'ok': True, 'result': result}).encode()
+
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='fake-telegram', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def call(self, method, params):
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        if method in ('setWebhook', 'deleteWebhook'):
+            self.webhook_url = params.get('url', '')
+            return True
+        if method == 'getWebhookInfo':
+            return {'url': self.webhook_url, 'has_custom_certificate': bool(self.webhook_url),
+                    'pending_update_count': 0}
+        if method == 'getFile':
+            file_id = params['file_id']
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_path': f'photos/{file_id}.jpg'}
+        if method == 'sendMessage':
+            chat_id = int(params['chat_id'])
+            with self._lock:
+                self.messages.append((time.time(), chat_id, params.get('text', '')))
+                message_id = len(self.messages)
+            return {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+                    'text': params.get('text', '')}
+        raise ValueError(f'Telegram method {method} is not supported by the stand-in')
+
+    def file(self, name):
+        file_id = name.rsplit('.', 1)[0]
+        with self._lock:
+            data = self.files.get(file_id)
+        if data is None:
+            data = make_photo(self.photo_width, self.photo_height, seed=abs(hash(file_id)) % 2 ** 32)
+            with self._lock:
+                self.files[file_id] = data
+        return data
+
+    def sent(self, prefix):
+        """Timestamps of the sent lines starting with prefix, coalesced messages hold several"""
+        with self._lock:
+            return [timestamp for timestamp, _, text in self.messages
+                    for line in text.split('\n') if line.startswith(prefix)]
@@ -0,0 +1,279 @@
+"""
+In-memory stand-ins for the AWS APIs used by polybot, yolo5 and metricStreamer.
+
+Only the calls the services make are implemented, with the same request/response shapes as boto3.
+install() points a service's `aws` module at these fakes.
+"""
+import io
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+
+from boto3.dynamodb.types import TypeDeserializer
+
+
+class FakeS3:
+
+    def __init__(self):
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        data = Body.read() if hasattr(Body, 'read') else bytes(Body)
+        with self._lock:
+            self.objects[(Bucket, Key)] = data
+        return {}
+
+    def get_object(self, Bucket, Key):
+        with self._lock:
+            data = self.objects[(Bucket, Key)]
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Config=None, **kwargs):
+        chunks = []
+        while True:
+            chunk = Fileobj.read(1024 * 1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.put_object(Bucket=Bucket, Key=Key, Body=b''.join(chunks))
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, 'rb') as f:
+            self.put_object(Bucket=Bucket, Key=Key, Body=f.read())
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        with open(Filename, 'wb') as f:
+            f.write(self.get_object(Bucket=Bucket, Key=Key)['Body'].read())
+
+
+class FakeSQS:
+    """Standard queues with long polling and visibility timeouts, keyed by whatever the services use as QueueUrl"""
+
+    def __init__(self, visibility_timeout=30):
+        self.visibility_timeout = visibility_timeout
+        self.queues = {}
+        self.sent = deque()  # (timestamp, queue) of every sent message, for the CloudWatch stand-in
+        self.deleted = deque()
+        self._cond = threading.Condition()
+
+    def _queue(self, url):
+        return self.queues.setdefault(url, {'visible': deque(), 'in_flight': {}})
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        message = {
+            'MessageId': str(uuid.uuid4()),
+            'Body': MessageBody,
+            'Attributes': {'SentTimestamp': str(int(time.time() * 1000))},
+        }
+        with self._cond:
+            self._queue(QueueUrl)['visible'].append(message)
+            self.sent.append((time.time(), QueueUrl))
+            self._cond.notify_all()
+        return {'MessageId': message['MessageId']}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs):
+        deadline = time.time() + WaitTimeSeconds
+        with self._cond:
+            queue = self._queue(QueueUrl)
+            while True:
+                self._expire(queue)
+                if queue['visible'] or time.time() >= deadline:
+                    break
+                self._cond.wait(min(0.5, deadline - time.time()))
+
+            messages = []
+            while queue['visible'] and len(messages) < MaxNumberOfMessages:
+                message = queue['visible'].popleft()
+                receipt_handle = str(uuid.uuid4())
+                queue['in_flight'][receipt_handle] = (message, time.time() + self.visibility_timeout)
+                messages.append({**message, 'ReceiptHandle': receipt_handle})
+        return {'Messages': messages} if messages else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        successful = []
+        with self._cond:
+            queue = self._queue(QueueUrl)
+            for entry in Entries:
+                if queue['in_flight'].pop(entry['ReceiptHandle'], None) is not None:
+                    self.deleted.append((time.time(), QueueUrl))
+                successful.append({'Id': entry['Id']})
+        return {'Successful': successful, 'Failed': []}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self.delete_message_batch(QueueUrl, [{'Id': '0', 'ReceiptHandle': ReceiptHandle}])
+        return {}
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        with self._cond:
+            queue = self._queue(QueueUrl)
+            message, _ = queue['in_flight'][ReceiptHandle]
+            queue['in_flight'][ReceiptHandle] = (message, time.time() + VisibilityTimeout)
+            self._cond.notify_all()
+        return {}
+
+    def get_queue_url(self, QueueName):
+        return {'QueueUrl': QueueName}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=None):
+        with self._cond:
+            queue = self._queue(QueueUrl)
+            self._expire(queue)
+            return {'Attributes': {
+                'ApproximateNumberOfMessages': str(len(queue['visible'])),
+                'ApproximateNumberOfMessagesNotVisible': str(len(queue['in_flight'])),
+            }}
+
+    def _expire(self, queue):
+        now = time.time()
+        for receipt_handle, (message, visible_at) in list(queue['in_flight'].items()):
+            if visible_at <= now:
+                del queue['in_flight'][receipt_handle]
+                queue['visible'].append(message)
+
+
+class FakeSQSResource:
+
+    def __init__(self, sqs):
+        self.sqs = sqs
+
+    def get_queue_by_name(self, QueueName):
+        return FakeQueue(self.sqs, QueueName)
+
+    def Queue(self, url):
+        return FakeQueue(self.sqs, url)
+
+
+class FakeQueue:
+
+    def __init__(self, sqs, url):
+        self.sqs = sqs
+        self.url = url
+        self.attributes = {}
+
+    def load(self):
+        self.attributes = self.sqs.get_queue_attributes(QueueUrl=self.url)['Attributes']
+
+
+class FakeDynamoDB:
+    """Client (batch_write_item) and resource (Table) in one object, items are kept deserialized"""
+
+    def __init__(self):
+        self.tables = {}
+        self.write_requests = 0
+        self._deserializer = TypeDeserializer()
+        self._lock = threading.Lock()
+
+    def batch_write_item(self, RequestItems):
+        with self._lock:
+            self.write_requests += 1
+            for table_name, requests in RequestItems.items():
+                for request in requests:
+                    item = {k: self._deserializer.deserialize(v) for k, v in request['PutRequest']['Item'].items()}
+                    self.Table(table_name).put_item(Item=item)
+        return {'UnprocessedItems': {}}
+
+    def Table(self, name):
+        return self.tables.setdefault(name, FakeTable(name))
+
+
+class FakeTable:
+
+    def __init__(self, name):
+        self.name = name
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def put_item(self, Item):
+        # The results table is keyed by prediction_id, the photo hash index by photo_hash
+        key = Item['prediction_id'] if 'prediction_id' in Item else Item['photo_hash']
+        with self._lock:
+            self.items[key] = Item
+        return {}
+
+    def get_item(self, Key):
+        with self._lock:
+            item = self.items.get(next(iter(Key.values())))
+        return {'Item': item} if item is not None else {}
+
+
+class FakeSecretsManager:
+
+    def __init__(self, secrets):
+        self.secrets = secrets
+
+    def get_secret_value(self, SecretId):
+        return {'SecretString': json.dumps(self.secrets[SecretId])}
+
+
+class FakeAutoscaling:
+
+    def __init__(self, group_name, instances=1):
+        self.group_name = group_name
+        self.instances = instances
+
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames):
+        return {'AutoScalingGroups': [{
+            'AutoScalingGroupName': self.group_name,
+            'DesiredCapacity': self.instances,
+            'Instances': [{'InstanceId': f'i-{n}', 'LifecycleState': 'InService'} for n in range(self.instances)],
+        }]}
+
+
+class FakeCloudWatch:
+    """Records put_metric_data calls, and answers the SQS sent/deleted queries from the fake queue's history"""
+
+    def __init__(self, sqs):
+        self.sqs = sqs
+        self.metrics = []  # (timestamp, namespace, name, value)
+
+    def put_metric_data(self, Namespace, MetricData):
+        now = time.time()
+        for datum in MetricData:
+            self.metrics.append((now, Namespace, datum['MetricName'], datum['Value']))
+        return {}
+
+    def get_metric_data(self, MetricDataQueries, **kwargs):
+        # Like CloudWatch, newest first: the current (partial) minute, then the previous complete one
+        current = time.time() // 60 * 60
+        periods = (current, current - 60)
+        events = {'NumberOfMessagesSent': self.sqs.sent, 'NumberOfMessagesDeleted': self.sqs.deleted}
+        results = []
+        for query in MetricDataQueries:
+            metric = query['MetricStat']['Metric']
+            queue_name = metric['Dimensions'][0]['Value']
+            history = [t for t, queue in list(events.get(metric['MetricName'], ()))
+                       if queue.rstrip('/').rsplit('/', 1)[-1] == queue_name]
+            results.append({
+                'Id': query['Id'],
+                'Timestamps': [datetime.fromtimestamp(start, timezone.utc) for start in periods],
+                'Values': [sum(1 for t in history if start <= t < start + 60) for start in periods],
+            })
+        return {'MetricDataResults': results}
+
+
+class FakeAWS:
+    """All the stand-ins of one benchmark run"""
+
+    def __init__(self, secrets, autoscaling_group_name, instances=1):
+        self.s3 = FakeS3()
+        self.sqs = FakeSQS()
+        self.dynamodb = FakeDynamoDB()
+        self.clients = {
+            's3': self.s3,
+            'sqs': self.sqs,
+            'dynamodb': self.dynamodb,
+            'secretsmanager': FakeSecretsManager(secrets),
+            'autoscaling': FakeAutoscaling(autoscaling_group_name, instances),
+            'cloudwatch': FakeCloudWatch(self.sqs),
+        }
+        self.resources = {'sqs': FakeSQSResource(self.sqs), 'dynamodb': self.dynamodb}
+
+    def install(self, aws_module):
+        """Makes the service's aws module hand out the fakes instead of boto3 clients"""
+        aws_module.client = self.clients.__getitem__
+        aws_module.resource = self.resources.__getitem__
+        aws_module.table = self.dynamodb.Table
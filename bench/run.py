@@ -0,0 +1,360 @@
+"""
+Offline end-to-end benchmark: Polybot, the yolo5 worker and metricStreamer run in this process against
+in-memory AWS stand-ins (fakes.py) and a local Telegram Bot API (fake_telegram.py). No AWS account,
+Telegram token or network access is needed.
+
+Updates from a JSONL file (one Telegram update or message per line) are replayed to Polybot's /loadTest/
+route at a fixed rate, and the run reports the throughput, p50/p95/p99 of every instrumented stage and
+the CPU and memory used. With --baseline, the run fails when it is slower than a previous --output.
+
+    python bench/run.py --rate 10 --count 200 --output bench.json
+    python bench/run.py --rate 10 --count 200 --baseline bench.json --env PIPELINE=0
+
+Inference is simulated (stub_detector.py) unless --real-model is given, which needs torch and the
+yolov5 repository next to yolo5/app.py, as in the yolo5 image.
+"""
+import argparse
+import copy
+import importlib
+import json
+import math
+import os
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from loguru import logger
+
+from fake_telegram import FakeTelegram
+from fakes import FakeAWS
+import stub_detector
+
+REPO = Path(__file__).resolve().parent.parent
+SECRET_NAME = 'ezdehar-secret'
+SECRETS = {
+    'TELEGRAM_TOKEN': 'bench-token',
+    'S3_BUCKET_URL': 'bench-images',
+    'BUCKET_NAME': 'bench-images',
+    'SQS_QUEUE_NAME': 'bench-queue',
+}
+AUTOSCALING_GROUP_NAME = 'ezdehar-yolo5-asg'
+RESULT_PREFIX = 'Detected objects'
+# Module names used by more than one service
+COLLIDING = ('app', 'labels', 'lanes', 'aws', 'telemetry')
+
+
+def load_service(directory, names, shared, overrides=None):
+    """
+    Imports a service's modules by their plain names, as the service itself does, then takes every module
+    loaded from the service's directory out of sys.modules, so the next service imports its own `app`,
+    `labels` or `lanes`. The `shared` modules (aws and telemetry, which are identical copies) and the
+    `overrides` are what the service's imports resolve to.
+    """
+    for name in COLLIDING:
+        sys.modules.pop(name, None)
+    sys.modules.update(shared)
+    sys.modules.update(overrides or {})
+
+    sys.path.insert(0, str(directory))
+    try:
+        return {name: importlib.import_module(name) for name in names}
+    finally:
+        sys.path.remove(str(directory))
+        for name, module in list(sys.modules.items()):
+            if module not in shared.values() and Path(getattr(module, '__file__', None) or '/').parent == directory:
+                sys.modules.pop(name, None)
+
+
+def load_shared(fakes):
+    sys.path.insert(0, str(REPO / 'yolo5'))
+    try:
+        shared = {name: importlib.import_module(name) for name in ('aws', 'telemetry')}
+    finally:
+        sys.path.remove(str(REPO / 'yolo5'))
+    fakes.install(shared['aws'])
+    return shared
+
+
+def record_samples(telemetry):
+    """Keeps every observed duration, the telemetry histograms only have bucket-level percentiles"""
+    samples = defaultdict(list)
+    observe = telemetry.observe
+
+    def recording_observe(stage, seconds, timings=None, prediction_id=None):
+        samples[stage].append(seconds)
+        observe(stage, seconds, timings, prediction_id)
+
+    # span() looks observe up in the module on every call, so it records too
+    telemetry.observe = recording_observe
+    return samples
+
+
+def start_polybot(shared, telegram, webhook_workers, webhook_queue_size):
+    """Same wiring as polybot/app.py's __main__ block, served on an ephemeral local port"""
+    from werkzeug.serving import make_server
+
+    modules = load_service(REPO / 'polybot', ('labels', 'dispatcher', 'sender', 'bot', 'app'), shared)
+    telebot = importlib.import_module('telebot')
+    telebot.apihelper.API_URL = f'http://127.0.0.1:{telegram.port}/bot{{0}}/{{1}}'
+    modules['sender'].TELEGRAM_API_URL = f'http://127.0.0.1:{telegram.port}/bot{{0}}/{{1}}'
+    modules['bot'].TELEGRAM_FILE_URL = f'http://127.0.0.1:{telegram.port}/file/bot{{0}}/{{1}}'
+
+    app = modules['app']
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    url = f'http://127.0.0.1:{server.server_port}'
+
+    app.TELEGRAM_TOKEN = SECRETS['TELEGRAM_TOKEN']
+    app.DYNAMODB_TABLE_NAME = 'ezdehar-table'
+    # The webhook is registered with the certificate next to app.py
+    cwd = os.getcwd()
+    os.chdir(REPO / 'polybot')
+    try:
+        app.bot = app.ObjectDetectionBot(url)
+    finally:
+        os.chdir(cwd)
+    app.dispatcher = app.UpdateDispatcher(app.bot.handle_message, workers=webhook_workers,
+                                          max_queue=webhook_queue_size)
+    app.telemetry.register_gauges('dispatcher', app.dispatcher.metrics)
+    app.telemetry.register_gauges('sender', app.bot.sender.metrics)
+    app.setup_routes()
+    app.STARTUP_SECONDS = time.time() - app.STARTED_AT
+    app.telemetry.observe('startup', app.STARTUP_SECONDS)
+
+    threading.Thread(target=server.serve_forever, name='polybot', daemon=True).start()
+    return url
+
+
+def start_worker(shared, polybot_url, real_model):
+    overrides = None
+    if real_model:
+        # detector.py imports yolov5's models and utils packages, and exports with its export.py
+        sys.path.append(str(REPO / 'yolo5'))
+    else:
+        overrides = {'detector': stub_detector}
+
+    modules = load_service(REPO / 'yolo5', ('labels', 'pipeline', 'result_cache', 'result_writer', 'supervisor',
+                                            'app'), shared, overrides)
+    app = modules['app']
+    app.polybot_url = f'{polybot_url}/results/'
+    threading.Thread(target=app.run_worker, name='yolo5', daemon=True).start()
+    return app
+
+
+def start_metric_streamer(shared, interval):
+    modules = load_service(REPO / 'metricStreamer', ('forecast', 'metric_streamer'), shared)
+    metric_streamer = modules['metric_streamer']
+    metric_streamer.INTERVAL = interval
+    threading.Thread(target=metric_streamer.run, args=(SECRETS['SQS_QUEUE_NAME'],), name='metric-streamer',
+                     daemon=True).start()
+
+
+def read_updates(path):
+    updates = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                update = json.loads(line)
+                updates.append(update if 'message' in update else {'message': update})
+    return updates
+
+
+def make_update(template, n, unique_photos, chats):
+    """
+    The n-th replayed update, with its own update_id and, unless photos repeat, its own file_ids.
+    With chats, the updates are spread over that many chat ids (the worker caps the jobs of one chat).
+    """
+    update = copy.deepcopy(template)
+    update['update_id'] = n
+    update['message']['message_id'] = n
+    if chats:
+        update['message']['chat']['id'] = 100000 + n % chats
+    if unique_photos:
+        for photo_size in update['message'].get('photo', []):
+            photo_size['file_id'] = f"{photo_size['file_id']}-{n}"
+    return update
+
+
+def replay(url, updates, rate, count, unique_photos, chats):
+    """Open-loop replay: update n is posted at n / rate seconds whatever the response times"""
+    session = requests.Session()
+    statuses = defaultdict(int)
+    photos = 0
+    lock = threading.Lock()
+
+    def post(update):
+        try:
+            status = session.post(f'{url}/loadTest/', json=update, timeout=30).status_code
+        except requests.RequestException:
+            status = 'error'
+        with lock:
+            statuses[status] += 1
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for n in range(count):
+            time.sleep(max(0.0, started + n / rate - time.time()))
+            update = make_update(updates[n % len(updates)], n + 1, unique_photos, chats)
+            photos += 'photo' in update['message']
+            executor.submit(post, update)
+    return started, photos, dict(statuses)
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of sorted values"""
+    return values[max(0, min(len(values) - 1, math.ceil(q * len(values)) - 1))]
+
+
+def stage_summary(samples):
+    summary = {}
+    for stage, values in sorted(samples.items()):
+        values = sorted(values)
+        if values:
+            summary[stage] = {
+                'count': len(values),
+                'mean': sum(values) / len(values),
+                'p50': percentile(values, 0.5),
+                'p95': percentile(values, 0.95),
+                'p99': percentile(values, 0.99),
+                'max': values[-1],
+            }
+    return summary
+
+
+def compare(report, baseline, tolerance, noise_floor=0.005):
+    """Regressions of the report against the baseline, stage latencies below noise_floor seconds are ignored"""
+    regressions = []
+    if report['throughput'] < baseline['throughput'] * (1 - tolerance):
+        regressions.append(f"throughput {report['throughput']:.2f}/s < baseline {baseline['throughput']:.2f}/s")
+
+    for stage, stats in report['stages'].items():
+        base = baseline['stages'].get(stage)
+        if base and stats['p95'] > base['p95'] * (1 + tolerance) and stats['p95'] - base['p95'] > noise_floor:
+            regressions.append(f"{stage} p95 {stats['p95'] * 1000:.1f}ms > baseline {base['p95'] * 1000:.1f}ms")
+    return regressions
+
+
+def print_report(report):
+    print(f"\n{report['results']}/{report['photos']} results for {report['requests']} updates "
+          f"offered at {report['rate']}/s in {report['duration']:.1f}s, HTTP statuses {report['statuses']}")
+    print(f"throughput: {report['throughput']:.2f} results/s")
+    print(f"\n{'stage':<24}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}  (ms)")
+    for stage, stats in report['stages'].items():
+        print(f"{stage:<24}{stats['count']:>8}" +
+              ''.join(f"{stats[key] * 1000:>10.1f}" for key in ('mean', 'p50', 'p95', 'p99', 'max')))
+    print(f"\nresources: {json.dumps(report['resources'])}")
+    print(f"backends: {json.dumps(report['backends'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', default=str(Path(__file__).parent / 'requests.jsonl'),
+                        help='JSONL file of Telegram updates (or messages) to replay round-robin')
+    parser.add_argument('--rate', type=float, default=5, help='updates per second')
+    parser.add_argument('--count', type=int, default=100, help='updates to send')
+    parser.add_argument('--repeat-photos', action='store_true',
+                        help='replay the same file_ids, so repeated photos hit the result cache')
+    parser.add_argument('--chats', type=int, default=50,
+                        help='spread the updates over this many chats, 0 keeps the chat ids of the file')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for results after the replay')
+    parser.add_argument('--batch-cost', type=float, default=0.02, help='simulated inference seconds per batch')
+    parser.add_argument('--image-cost', type=float, default=0.05, help='simulated inference seconds per image')
+    parser.add_argument('--real-model', action='store_true', help='run the real yolov5 detector')
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help='seconds added to every Telegram call')
+    parser.add_argument('--photo-size', default='1280x960', help='WIDTHxHEIGHT of the generated photos')
+    parser.add_argument('--webhook-workers', type=int, default=int(os.environ.get('WEBHOOK_WORKERS', 8)))
+    parser.add_argument('--webhook-queue-size', type=int, default=int(os.environ.get('WEBHOOK_QUEUE_SIZE', 1000)))
+    parser.add_argument('--metric-interval', type=float, default=1, help='metricStreamer publication interval')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='environment variable for the services, e.g. PIPELINE=0 (repeatable)')
+    parser.add_argument('--log-level', default='WARNING', help='level of the services\' logs')
+    parser.add_argument('--output', help='write the report as JSON')
+    parser.add_argument('--baseline', help='report of a previous run, exit with status 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative regression')
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+
+    # The services read their configuration from the environment at import time
+    os.environ['METRICS_PORT'] = '0'
+    for assignment in args.env:
+        key, _, value = assignment.partition('=')
+        os.environ[key] = value
+    stub_detector.BATCH_COST = args.batch_cost
+    stub_detector.IMAGE_COST = args.image_cost
+
+    width, height = (int(size) for size in args.photo_size.split('x'))
+    telegram = FakeTelegram(photo_width=width, photo_height=height, latency=args.telegram_latency).start()
+    fakes = FakeAWS({SECRET_NAME: SECRETS}, AUTOSCALING_GROUP_NAME)
+    shared = load_shared(fakes)
+    samples = record_samples(shared['telemetry'])
+
+    polybot_url = start_polybot(shared, telegram, args.webhook_workers, args.webhook_queue_size)
+    start_worker(shared, polybot_url, args.real_model)
+    start_metric_streamer(shared, args.metric_interval)
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    started, photos, statuses = replay(polybot_url, read_updates(args.requests), args.rate, args.count,
+                                       unique_photos=not args.repeat_photos, chats=args.chats)
+
+    deadline = time.time() + args.timeout
+    while len(telegram.sent(RESULT_PREFIX)) < photos and time.time() < deadline:
+        time.sleep(0.1)
+    results = telegram.sent(RESULT_PREFIX)
+    finished = max(results) if results else time.time()
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    duration = max(finished - started, 1e-9)
+    cpu_user = usage_after.ru_utime - usage_before.ru_utime
+    cpu_system = usage_after.ru_stime - usage_before.ru_stime
+    report = {
+        'requests': args.count,
+        'photos': photos,
+        'results': len(results),
+        'rate': args.rate,
+        'statuses': statuses,
+        'duration': duration,
+        'throughput': len(results) / duration,
+        'stages': stage_summary(samples),
+        'resources': {
+            'cpu_user': round(cpu_user, 3),
+            'cpu_system': round(cpu_system, 3),
+            'cpu_utilization': round((cpu_user + cpu_system) / duration, 3),
+            'max_rss_mb': round(usage_after.ru_maxrss / 1024, 1),
+            'threads': threading.active_count(),
+        },
+        'backends': {
+            's3_objects': len(fakes.s3.objects),
+            'dynamodb_write_requests': fakes.dynamodb.write_requests,
+            'telegram_messages': len(telegram.messages),
+            'max_backlog_per_instance': max((value for _, _, name, value in fakes.clients['cloudwatch'].metrics
+                                             if name == 'BacklogPerInstance'), default=0),
+        },
+        'env': args.env,
+    }
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+        if regressions:
+            sys.exit(1)
+
+    if len(results) < photos:
+        print(f'Only {len(results)} of {photos} results arrived within {args.timeout}s')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
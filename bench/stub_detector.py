@@ -0,0 +1,75 @@
+"""
+Drop-in replacement for yolo5/detector.py when torch and the yolov5 repo are not available.
+
+Inference is simulated with a fixed cost per batch plus a cost per image, so the benchmark measures
+everything around the model: queueing, S3, DynamoDB, the pipeline stages and Polybot.
+"""
+import time
+
+import numpy as np
+
+BACKENDS = ('torch', 'onnx', 'onnx-int8')
+NAMES = {0: 'person', 2: 'car', 16: 'dog'}
+
+# Set by the benchmark runner
+BATCH_COST = 0.02
+IMAGE_COST = 0.05
+
+
+def backend_weights(backend, weights='yolov5s.pt', imgsz=640):
+    return weights
+
+
+class Detections:
+
+    def __init__(self, boxes, confidences, class_ids, names, shape):
+        self.boxes = boxes
+        self.confidences = confidences
+        self.class_ids = class_ids
+        self.names = names
+        self.shape = shape
+
+    def __len__(self):
+        return len(self.class_ids)
+
+    @property
+    def classes(self):
+        return [self.names[int(c)] for c in self.class_ids]
+
+    def labels(self):
+        h, w = self.shape
+        return [{
+            'class': self.names[int(class_id)],
+            'cx': ((x1 + x2) / 2) / w,
+            'cy': ((y1 + y2) / 2) / h,
+            'width': (x2 - x1) / w,
+            'height': (y2 - y1) / h,
+        } for (x1, y1, x2, y2), class_id in zip(self.boxes.tolist(), self.class_ids.tolist())]
+
+
+class Detector:
+
+    def __init__(self, weights='yolov5s.pt', data='data/coco128.yaml', imgsz=640, warmup_batch_sizes=(1,), **kwargs):
+        self.names = NAMES
+        self.imgsz = imgsz
+        for batch_size in warmup_batch_sizes:
+            self.predict_batch([np.zeros((imgsz, imgsz, 3), dtype=np.uint8)] * batch_size)
+
+    def predict(self, image):
+        return self.predict_batch([image])[0]
+
+    def predict_batch(self, images):
+        time.sleep(BATCH_COST + IMAGE_COST * len(images))
+        return [self._detections(image.shape[:2]) for image in images]
+
+    def annotate(self, image, detections, line_width=3):
+        annotated = image.copy()
+        for x1, y1, x2, y2 in detections.boxes.astype(int).tolist():
+            annotated[y1:y2, x1:x1 + line_width] = 255
+            annotated[y1:y2, x2 - line_width:x2] = 255
+        return annotated
+
+    def _detections(self, shape):
+        h, w = shape
+        boxes = np.array([[0.1 * w, 0.1 * h, 0.5 * w, 0.9 * h], [0.6 * w, 0.5 * h, 0.9 * w, 0.8 * h]])
+        return Detections(boxes, np.array([0.9, 0.7]), np.array([0, 16]), self.names, shape)
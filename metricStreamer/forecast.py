@@ -0,0 +1,117 @@
+import csv
+import math
+
+
+class HoltForecaster:
+    """
+    Holt's linear (double exponential) smoothing: an EWMA of the level plus an EWMA of its trend.
+    With beta=0 it is a plain EWMA.
+    """
+
+    def __init__(self, alpha=0.5, beta=0.2):
+        self.alpha = alpha
+        self.beta = beta
+        self.level = None
+        self.trend = 0.0
+
+    def update(self, value):
+        if self.level is None:
+            self.level = value
+            return
+        previous_level = self.level
+        self.level = self.alpha * value + (1 - self.alpha) * (self.level + self.trend)
+        self.trend = self.beta * (self.level - previous_level) + (1 - self.beta) * self.trend
+
+    def forecast(self, steps=1):
+        if self.level is None:
+            return 0.0
+        return max(0.0, self.level + steps * self.trend)
+
+
+class ScalingController:
+    """
+    Predicts how many instances are needed to keep up with the arriving messages and to clear the
+    current backlog within the latency SLO:
+
+        required = (forecast arrival rate + backlog / slo) / per-instance service rate
+
+    The arrival rate is forecast `horizon` seconds ahead (about the time a new instance needs to start
+    serving). The per-instance service rate is learned from the samples where instances had work,
+    starting from `service_rate`.
+    """
+
+    def __init__(self, slo=60, horizon=120, service_rate=1.0, min_instances=1, max_instances=10,
+                 alpha=0.5, beta=0.2, service_alpha=0.2):
+        self.slo = slo
+        self.horizon = horizon
+        self.service_rate = service_rate
+        self.min_instances = min_instances
+        self.max_instances = max_instances
+        self.service_alpha = service_alpha
+
+        self.arrivals = HoltForecaster(alpha, beta)
+        self._previous = None  # (timestamp, backlog) of the previous sample
+        self._interval = None
+
+    def update(self, timestamp, backlog, in_service, arrival_rate=None, processing_rate=None):
+        """
+        Feeds one sample, returns the number of instances required.
+        :param backlog: visible + in-flight messages
+        :param arrival_rate: messages sent per second, estimated from the backlog change when unknown
+        :param processing_rate: messages deleted per second, across all instances. When unknown, the
+            arrival estimate assumes the instances in service ran at the learned per-instance service rate,
+            but never processed more than the backlog they had
+        """
+        if self._previous is not None:
+            dt = timestamp - self._previous[0]
+            if dt > 0:
+                self._interval = dt
+                if arrival_rate is None:
+                    processed = processing_rate
+                    if processed is None:
+                        processed = min(self.service_rate * in_service, self._previous[1] / dt)
+                    arrival_rate = max(0.0, (backlog - self._previous[1]) / dt + processed)
+        self._previous = (timestamp, backlog)
+
+        if arrival_rate is not None:
+            self.arrivals.update(arrival_rate)
+
+        # Only busy instances tell how fast an instance can go, idle ones just follow the arrival rate
+        if processing_rate is not None and in_service > 0 and backlog > in_service:
+            observed = processing_rate / in_service
+            self.service_rate += self.service_alpha * (observed - self.service_rate)
+
+        return self.required_instances(backlog)
+
+    def forecast_arrival_rate(self):
+        steps = self.horizon / self._interval if self._interval else 1
+        return self.arrivals.forecast(steps)
+
+    def required_instances(self, backlog):
+        demand = self.forecast_arrival_rate() + backlog / self.slo
+        required = math.ceil(demand / max(self.service_rate, 1e-6))
+        return min(max(required, self.min_instances), self.max_instances)
+
+
+def replay(path, controller):
+    """
+    Runs the controller against a recorded trace, a CSV with the columns
+        timestamp, visible, in_flight, in_service[, arrival_rate, processing_rate]
+    Without the optional columns the arrival rate is estimated from the backlog change and the service rate.
+    :return: one (timestamp, backlog, in_service, forecast arrival rate, required instances) row per sample
+    """
+    rows = []
+    with open(path, newline='') as trace:
+        for sample in csv.DictReader(trace):
+            timestamp = float(sample['timestamp'])
+            backlog = int(sample['visible']) + int(sample['in_flight'])
+            in_service = int(sample['in_service'])
+            required = controller.update(timestamp, backlog, in_service,
+                                         arrival_rate=_optional_float(sample.get('arrival_rate')),
+                                         processing_rate=_optional_float(sample.get('processing_rate')))
+            rows.append((timestamp, backlog, in_service, controller.forecast_arrival_rate(), required))
+    return rows
+
+
+def _optional_float(value):
+    return float(value) if value not in (None, '') else None
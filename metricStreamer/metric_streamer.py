@@ -1,73 +1,224 @@
-import json
-
-import boto3
+import argparse
+import os
 import time
+from datetime import datetime, timedelta, timezone
 
-sqs_client = boto3.resource('sqs', region_name='eu-west-3')
-asg_client = boto3.client('autoscaling', region_name='eu-west-3')
-secrets_manager = boto3.client('secretsmanager', region_name='eu-west-3')
-
-def get_secret(secret_name):
-    try:
-        secret_response = secrets_manager.get_secret_value(SecretId=secret_name)
-        return json.loads(secret_response['SecretString'])
-    except Exception as e:
-        print(f"Error retrieving secret '{secret_name}': {e}")
-        raise
+import aws
+from forecast import ScalingController, replay
 
-secrets = get_secret('ezdehar-secret')
 AUTOSCALING_GROUP_NAME = 'ezdehar-yolo5-asg'
-QUEUE_NAME = secrets['SQS_QUEUE_NAME']
-NAMESPACE = 'Ezdehar-Metrics'
+# Must match the Namespace of the scaling policy in config.json
+NAMESPACE = 'YoloBotEMetrics'
+# Visible + in-flight messages per InService instance. A busy instance that keeps up already holds up to
+# MAX_IN_FLIGHT x worker processes messages in flight (the worker's settings, 32 x 2 with WORKERS=auto and
+# THREADS_PER_WORKER=2 on 4 vCPUs), so the TargetValue in config.json must be above that: it is 96, one and
+# a half instances' pipelines worth. Retune it with MAX_IN_FLIGHT, WORKERS or the instance type
 METRIC_NAME = 'BacklogPerInstance'
+PROCESSING_RATE_METRIC_NAME = 'ProcessingRate'
+# Predictive mode only
+REQUIRED_INSTANCES_METRIC_NAME = 'RequiredInstances'
+ARRIVAL_RATE_FORECAST_METRIC_NAME = 'ArrivalRateForecast'
+# Seconds between two metric publications, the metrics are published with 1-second resolution
+INTERVAL = int(os.environ.get('METRIC_INTERVAL', 10))
+# Priority lanes, the same setting as Polybot's and the worker's: the backlog is summed over all their queues
+SQS_LANES = os.environ.get('SQS_LANES', '')
+
+# Clients and the queue handle are created once and reused by every loop
+sqs_client = aws.resource('sqs')
+asg_client = aws.client('autoscaling')
+cloudwatch = aws.client('cloudwatch')
+
+DIMENSIONS = [
+    {
+        'Name': 'AutoScalingGroupName',
+        'Value': AUTOSCALING_GROUP_NAME
+    }
+]
+
+
+def lane_queues(spec, default_queue):
+    """
+    The queues of 'interactive=<queue url>:4,bulk=<queue url>:1' (weights are ignored) and the default queue,
+    which gets the priorities without a lane of their own
+    """
+    queues = [default_queue]
+    for entry in filter(None, (entry.strip() for entry in spec.split(','))):
+        queue, _, weight = entry.partition('=')[2].rpartition(':')
+        if not weight.isdigit():
+            # No weight, the colon belongs to the URL
+            queue = f'{queue}:{weight}' if queue else weight
+        if queue not in queues:
+            queues.append(queue)
+    return queues
+
+
+def get_queue(queue):
+    """Queue handle from a queue URL or name"""
+    if queue.startswith('https://') or queue.startswith('http://'):
+        return sqs_client.Queue(queue)
+    return sqs_client.get_queue_by_name(QueueName=queue)
+
+
+def cloudwatch_queue_name(queue):
+    # CloudWatch's SQS metrics are by queue name, the last part of the URL
+    return queue.rstrip('/').rsplit('/', 1)[-1]
+
+
+def get_backlog(queue):
+    """Messages waiting in the queue plus messages being processed (received but not deleted yet)"""
+    queue.load()
+    visible = int(queue.attributes.get('ApproximateNumberOfMessages', 0))
+    in_flight = int(queue.attributes.get('ApproximateNumberOfMessagesNotVisible', 0))
+    return visible, in_flight
+
+
+def get_in_service_instances():
+    asg_groups = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[AUTOSCALING_GROUP_NAME])['AutoScalingGroups']
+
+    if not asg_groups:
+        raise RuntimeError('Autoscaling group not found')
+
+    # Instances still launching (or terminating) do not process messages
+    return sum(1 for instance in asg_groups[0]['Instances'] if instance['LifecycleState'] == 'InService')
+
+
+def get_queue_rates(queue_name, window=300):
+    """
+    Messages sent to and deleted from the queue per second, from the most recent complete 1-minute SQS
+    datapoints. The current minute is skipped, its partial sum would read as a drop in the rates.
+    :return: (arrival rate, processing rate), None when CloudWatch has no complete datapoint yet
+    """
+    end = datetime.now(timezone.utc)
+    queries = [
+        {
+            'Id': query_id,
+            'MetricStat': {
+                'Metric': {
+                    'Namespace': 'AWS/SQS',
+                    'MetricName': metric_name,
+                    'Dimensions': [{'Name': 'QueueName', 'Value': queue_name}]
+                },
+                'Period': 60,
+                'Stat': 'Sum'
+            }
+        }
+        for query_id, metric_name in (('sent', 'NumberOfMessagesSent'), ('deleted', 'NumberOfMessagesDeleted'))
+    ]
+    response = cloudwatch.get_metric_data(MetricDataQueries=queries, StartTime=end - timedelta(seconds=window),
+                                          EndTime=end, ScanBy='TimestampDescending')
+
+    rates = {}
+    for result in response['MetricDataResults']:
+        values = [value for timestamp, value in zip(result['Timestamps'], result['Values'])
+                  if timestamp + timedelta(seconds=60) <= end]
+        rates[result['Id']] = values[0] / 60 if values else None
+    return rates.get('sent'), rates.get('deleted')
+
+
+def publish_metrics(metrics):
+    """Publishes all the metrics in one high-resolution put_metric_data call"""
+    cloudwatch.put_metric_data(
+        Namespace=NAMESPACE,
+        MetricData=[
+            {
+                'MetricName': name,
+                'Value': value,
+                'Unit': unit,
+                'StorageResolution': 1,
+                'Dimensions': DIMENSIONS
+            }
+            for name, value, unit in metrics
+        ]
+    )
+
+
+def add_rates(rates):
+    """Sum of the rates CloudWatch has a datapoint for, None when it has none"""
+    known = [rate for rate in rates if rate is not None]
+    return sum(known) if known else None
+
+
+def run(default_queue, controller=None):
+    """
+    Publishes the scaling metrics forever, for the backlog of all the lanes' queues.
+    With a controller, also publishes the predicted instance count.
+    """
+    queues = lane_queues(SQS_LANES, default_queue)
+    handles = [get_queue(queue) for queue in queues]
+
+    while True:
+        started = time.time()
+        try:
+            backlogs = [get_backlog(handle) for handle in handles]
+            visible = sum(queue_visible for queue_visible, _ in backlogs)
+            in_flight = sum(queue_in_flight for _, queue_in_flight in backlogs)
+            in_service = get_in_service_instances()
+            try:
+                rates = [get_queue_rates(cloudwatch_queue_name(queue)) for queue in queues]
+                arrival_rate = add_rates(rate[0] for rate in rates)
+                processing_rate = add_rates(rate[1] for rate in rates)
+            except Exception as e:
+                # The rates are extras, BacklogPerInstance drives the scaling policy and is published anyway
+                print(f'Error getting the queue rates: {e}')
+                arrival_rate = processing_rate = None
+
+            # With no instance in service the whole backlog is reported, so the group scales out from zero
+            backlog_per_instance = (visible + in_flight) / max(in_service, 1)
+
+            print(f'BacklogPerInstance: {backlog_per_instance} (visible {visible}, in flight {in_flight}, '
+                  f'in service {in_service}), ProcessingRate: {processing_rate}')
+
+            metrics = [(METRIC_NAME, backlog_per_instance, 'Count')]
+            if processing_rate is not None:
+                metrics.append((PROCESSING_RATE_METRIC_NAME, processing_rate, 'Count/Second'))
+
+            if controller is not None:
+                required = controller.update(started, visible + in_flight, in_service,
+                                             arrival_rate=arrival_rate, processing_rate=processing_rate)
+                forecast = controller.forecast_arrival_rate()
+                print(f'RequiredInstances: {required}, ArrivalRateForecast: {forecast}')
+                metrics.append((REQUIRED_INSTANCES_METRIC_NAME, required, 'Count'))
+                metrics.append((ARRIVAL_RATE_FORECAST_METRIC_NAME, forecast, 'Count/Second'))
+
+            # Send the metrics to CloudWatch
+            publish_metrics(metrics)
+
+        except Exception as e:
+            print(f'Error: {e}')
+
+        finally:
+            # Keep a steady cadence whatever the time spent in the AWS calls
+            time.sleep(max(0, INTERVAL - (time.time() - started)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--predictive', action='store_true',
+                        help='also publish the instance count forecast by the scaling controller')
+    parser.add_argument('--replay', metavar='TRACE_CSV',
+                        help='run the scaling controller offline against a recorded queue trace and exit')
+    parser.add_argument('--slo', type=float, default=60, help='seconds to clear the backlog in')
+    parser.add_argument('--horizon', type=float, default=120, help='seconds ahead to forecast the arrival rate')
+    parser.add_argument('--service-rate', type=float, default=1.0, help='initial messages/second per instance')
+    parser.add_argument('--min-instances', type=int, default=1)
+    parser.add_argument('--max-instances', type=int, default=10)
+    parser.add_argument('--alpha', type=float, default=0.5, help='arrival rate level smoothing')
+    parser.add_argument('--beta', type=float, default=0.2, help='arrival rate trend smoothing')
+    args = parser.parse_args()
+
+    controller = ScalingController(slo=args.slo, horizon=args.horizon, service_rate=args.service_rate,
+                                   min_instances=args.min_instances, max_instances=args.max_instances,
+                                   alpha=args.alpha, beta=args.beta)
+
+    if args.replay:
+        print('timestamp,backlog,in_service,arrival_rate_forecast,required_instances')
+        for timestamp, backlog, in_service, forecast, required in replay(args.replay, controller):
+            print(f'{timestamp},{backlog},{in_service},{forecast:.3f},{required}')
+        return
+
+    secrets = aws.get_secret('ezdehar-secret')
+    run(secrets['SQS_QUEUE_NAME'], controller if args.predictive else None)
+
 
-while True:
-    try:
-        # Get the number of messages in the SQS queue
-        queue = sqs_client.get_queue_by_name(QueueName=QUEUE_NAME)
-        msgs_in_queue = int(queue.attributes.get('ApproximateNumberOfMessages'))
-
-        # Get the Auto Scaling Group information
-        asg_groups = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[AUTOSCALING_GROUP_NAME])['AutoScalingGroups']
-
-        if not asg_groups:
-            raise RuntimeError('Autoscaling group not found')
-        else:
-            asg_size = asg_groups[0]['DesiredCapacity']
-
-        if asg_size == 0:
-            print('Auto Scaling Group has a desired capacity of zero. Skipping calculation.')
-            time.sleep(30)
-            continue
-
-        # Calculate BacklogPerInstance
-        backlog_per_instance = msgs_in_queue / asg_size
-
-        # Print for testing (you can remove this in production)
-        print(f'BacklogPerInstance: {backlog_per_instance}')
-
-        # TODO: Send BacklogPerInstance to CloudWatch
-        cloudwatch = boto3.client('cloudwatch', region_name='eu-west-3')
-        cloudwatch.put_metric_data(
-            Namespace=NAMESPACE,
-            MetricData=[
-                {
-                    'MetricName': METRIC_NAME,
-                    'Value': backlog_per_instance,
-                    'Unit': 'Count',
-                    'Dimensions': [
-                        {
-                            'Name': 'AutoScalingGroupName',
-                            'Value': AUTOSCALING_GROUP_NAME
-                        }
-                    ]
-                }
-            ]
-        )
-
-    except Exception as e:
-        print(f'Error: {e}')
-
-    finally:
-        # Sleep for 30 seconds before the next iteration
-        time.sleep(30)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Sanity check of the scaling controller, replayed against synthetic queue traces.
+
+    python3 replay_check.py
+
+Each trace is written as a CSV in the --replay format (without the optional rate columns, like a trace
+recorded from ApproximateNumberOfMessages only) and replayed with the default controller settings.
+The check fails (exit code 1) when the last required instance count is out of the expected range:
+an idle queue must scale in to the minimum, a growing backlog must scale out.
+"""
+import csv
+import sys
+import tempfile
+
+from forecast import ScalingController, replay
+
+INTERVAL = 60
+SAMPLES = 40
+
+
+def idle(i):
+    return 0, 0, 5
+
+
+def steady(i):
+    # A few messages always being worked on, the instances keep up easily
+    return 0, 3, 5
+
+
+def growing(i):
+    return 30 * i, 10, 2
+
+
+# name -> (sample i -> (visible, in_flight, in_service), lowest and highest acceptable last required count)
+TRACES = {
+    'idle': (idle, 1, 1),
+    'steady': (steady, 1, 2),
+    'growing': (growing, 3, 10),
+}
+
+
+def replay_trace(sample):
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='') as trace:
+        writer = csv.writer(trace)
+        writer.writerow(['timestamp', 'visible', 'in_flight', 'in_service'])
+        for i in range(SAMPLES):
+            writer.writerow([i * INTERVAL, *sample(i)])
+        trace.flush()
+        return replay(trace.name, ScalingController())
+
+
+def main():
+    failed = False
+    for name, (sample, lowest, highest) in TRACES.items():
+        timestamp, backlog, in_service, forecast, required = replay_trace(sample)[-1]
+        ok = lowest <= required <= highest
+        failed |= not ok
+        print(f'{name}: backlog {backlog}, in service {in_service}, arrival rate forecast {forecast:.3f}, '
+              f'required {required} (expected {lowest}-{highest}) {"ok" if ok else "FAILED"}')
+
+    if failed:
+        print('Replay check FAILED')
+        sys.exit(1)
+    print('Replay check passed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import threading
+import time
+from loguru import logger
+
+
+class AlbumCollector:
+    """
+    Gathers the photos of a Telegram album. Every photo of an album comes as a separate update with the same
+    media_group_id, usually within a fraction of a second, and possibly handled by different dispatcher threads.
+
+    A photo is announced with begin() when its update arrives and added with complete() once it is in S3
+    (or dropped with abort()). The album is handed to flush(media_group_id, chat_id, photos, received_at) when
+    no upload is pending and no photo arrived for `window` seconds, photos in message order.
+    """
+
+    def __init__(self, flush, window=1.0, max_wait=10.0):
+        self.flush = flush
+        self.window = window
+        self.max_wait = max_wait  # an album is flushed this long after its first photo whatever happens
+
+        self._albums = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._flush_loop, name='album-collector', daemon=True).start()
+
+    def begin(self, media_group_id, chat_id, received_at):
+        """Returns True for the first photo of the album"""
+        with self._lock:
+            album = self._albums.get(media_group_id)
+            first = album is None
+            if first:
+                album = self._albums[media_group_id] = {
+                    'chat_id': chat_id,
+                    'received_at': received_at,
+                    'photos': [],
+                    'pending': 0,
+                }
+            album['pending'] += 1
+            album['last_arrival'] = time.time()
+            return first
+
+    def complete(self, media_group_id, photo):
+        """
+        photo is a dict with at least a message_id, the album's job is built from these.
+        Returns False when the album was already flushed without this photo (after max_wait).
+        """
+        with self._lock:
+            album = self._albums.get(media_group_id)
+            if album is None:
+                return False
+            album['photos'].append(photo)
+            album['pending'] -= 1
+            return True
+
+    def abort(self, media_group_id):
+        with self._lock:
+            album = self._albums.get(media_group_id)
+            if album is not None:
+                album['pending'] -= 1
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(min(0.1, self.window))
+            now = time.time()
+            with self._lock:
+                ready = [media_group_id for media_group_id, album in self._albums.items()
+                         if (album['pending'] == 0 and now - album['last_arrival'] >= self.window)
+                         or now - album['received_at'] >= self.max_wait]
+                albums = [(media_group_id, self._albums.pop(media_group_id)) for media_group_id in ready]
+
+            for media_group_id, album in albums:
+                if not album['photos']:
+                    continue
+                photos = sorted(album['photos'], key=lambda photo: photo['message_id'])
+                try:
+                    self.flush(media_group_id, album['chat_id'], photos, album['received_at'])
+                except Exception as e:
+                    logger.error(f'Error sending album {media_group_id}: {e}')
@@ -1,9 +1,15 @@
+import time
+# Taken before the heavy imports, so the reported startup time includes them
+STARTED_AT = time.time()
 import flask
 from flask import request
 import os
 from bot import ObjectDetectionBot
-import boto3
-import json
+from dispatcher import UpdateDispatcher
+from labels import count_classes, decode_labels
+from lanes import BULK, INTERACTIVE
+import aws
+import telemetry
 from botocore.exceptions import ClientError
 from flask import abort
 from loguru import logger
@@ -11,23 +17,69 @@ from loguru import logger
 app = flask.Flask(__name__)
 
 
-def format_prediction_results(prediction_result):
-    # Extract relevant information from the prediction result
-    prediction_id = prediction_result["prediction_id"]
-    labels = prediction_result["labels"]
+def format_counts(object_counts):
+    return ", ".join(f"{obj}: {int(count)}" for obj, count in object_counts.items()) or "nothing"
+
 
-    # Create a dictionary to store the count of each detected object
-    object_counts = {}
+def format_prediction_results(prediction_result):
+    # Items written by newer workers carry precomputed per-class counts
+    object_counts = prediction_result.get("counts")
+
+    if object_counts is None:
+        # Count each detected object from the labels, in whatever format they were stored
+        object_counts = count_classes(decode_labels(prediction_result))
+
+    # An album gets one reply, with the counts of every photo and the total
+    images = prediction_result.get("images") or []
+    if len(images) > 1:
+        lines = [f"Photo {n}: {format_counts(image.get('counts', {}))}" for n, image in enumerate(images, start=1)]
+        return f"Detected objects in {len(images)} photos:\n" + "\n".join(lines) + \
+            f"\nTotal: {format_counts(object_counts)}"
+
+    return f"Detected objects: {format_counts(object_counts)}"
+
+
+def send_prediction_result(result):
+    """
+    Replies to the user with a pushed result. The DynamoDB item is only read when the payload
+    doesn't carry the chat_id and the label summary.
+    """
+    if result.get('chat_id') is None or (result.get('counts') is None and result.get('labels') is None):
+        response = aws.table(DYNAMODB_TABLE_NAME).get_item(Key={'prediction_id': result['prediction_id']})
+        result_item = response.get('Item')
+        if not result_item:
+            raise LookupError(f"No data found for prediction {result['prediction_id']}")
+        result = {**result_item, **{key: value for key, value in result.items() if value is not None}}
+
+    # Queued for the outbound sender, several results to one chat may go out as one message
+    delivery = bot.send_text(result['chat_id'], format_prediction_results(result), kind='result')
+
+    # From the webhook receiving the photo to the result being delivered
+    if result.get('received_at'):
+        received_at = float(result['received_at'])
+        delivery.add_done_callback(lambda future: future.exception() is None and telemetry.observe(
+            'end_to_end', time.time() - received_at, prediction_id=result.get('prediction_id')))
+
+
+def dispatch_update(req, priority=INTERACTIVE, dedup=True):
+    """
+    Validates and queues the update for the background workers, the request returns right away.
+    :param dedup: skip an update_id already seen, only Telegram's redeliveries of an update share it
+    """
+    if not isinstance(req, dict):
+        return 'Invalid update', 400
+
+    # Other update types (edited messages, channel posts, ...) are not handled
+    if 'message' not in req:
+        return 'Ok'
 
-    # Iterate over each label in the prediction result
-    for label in labels:
-        class_name = label["class"]
-        object_counts[class_name] = object_counts.get(class_name, 0) + 1
+    update_id = req.get('update_id') if dedup else None
+    if not dispatcher.submit(req['message'], update_id=update_id, priority=priority):
+        # Telegram retries the delivery later
+        return 'Too many pending updates', 503
+    return 'Ok'
 
-    # Convert the object counts dictionary to a formatted string
-    formatted_results = ", ".join(f"{obj}: {count}" for obj, count in object_counts.items())
 
-    return f"Detected objects: {formatted_results}"
 def setup_routes():
     @app.route('/', methods=['GET'])
     def index():
@@ -36,10 +88,9 @@ def setup_routes():
 
     @app.route(f'/{TELEGRAM_TOKEN}/', methods=['POST'])
     def webhook():
-        req = request.get_json()
+        req = request.get_json(silent=True)
         logger.info(f"Received a POST request on /{TELEGRAM_TOKEN}/: {req}")
-        bot.handle_message(req['message'])
-        return 'Ok'
+        return dispatch_update(req)
 
     @app.route(f'/results/', methods=['GET'])
     def results():
@@ -51,7 +102,7 @@ def setup_routes():
                 return 'Prediction ID not provided', 400
 
             # Retrieve results from DynamoDB
-            response = dynamodb_table.get_item(Key={'prediction_id': prediction_id})
+            response = aws.table(DYNAMODB_TABLE_NAME).get_item(Key={'prediction_id': prediction_id})
             result_item = response.get('Item', {})
 
             # Check if the result_item is empty
@@ -63,7 +114,7 @@ def setup_routes():
             chat_id = result_item.get('chat_id')
             text_results = format_prediction_results(result_item)
 
-            bot.send_text(chat_id, text_results)
+            bot.send_text(chat_id, text_results, kind='result')
             return 'Results sent successfully'
 
         except ClientError as dynamodb_error:
@@ -79,41 +130,79 @@ def setup_routes():
             # Return a 500 Internal Server Error response with a generic error message
             return 'Internal Server Error', 500
 
+    @app.route(f'/results/', methods=['POST'])
+    def push_results():
+        req = request.get_json(silent=True)
+        if not req:
+            return 'Results not provided', 400
+
+        # Either a single result or {'results': [...]} from a micro-batching worker
+        results = req.get('results', [req])
+        logger.info(f"Received a POST request on /results/ with {len(results)} results")
+
+        sent, failed = [], []
+        for result in results:
+            prediction_id = result.get('prediction_id')
+            try:
+                send_prediction_result(result)
+                sent.append(prediction_id)
+            except Exception as e:
+                logger.error(f"Error processing results of {prediction_id}: {e}")
+                failed.append(prediction_id)
+
+        # 207: the worker reads `failed` and leaves those predictions in the queue to be retried
+        status = (500 if not sent else 207) if failed else 200
+        return flask.jsonify(sent=sent, failed=failed), status
+
     @app.route(f'/loadTest/', methods=['POST'])
     def load_test():
-        req = request.get_json()
+        req = request.get_json(silent=True)
         logger.info(f"Received a POST request on /loadTest/: {req}")
-        bot.handle_message(req['message'])
-        return 'Ok'
+        # Load tests go to the bulk lane, they must not slow down real users, and may replay the same update
+        return dispatch_update(req, priority=BULK, dedup=False)
+
+    @app.route(f'/ready/', methods=['GET'])
+    def ready():
+        # Ready to take updates: the webhook is registered and the update queue has room
+        if dispatcher.queue.full():
+            return 'Update queue is full', 503
+        return flask.jsonify(ready=True, startup_seconds=STARTUP_SECONDS)
+
+    @app.route(f'/metrics/', methods=['GET'])
+    def metrics():
+        if request.args.get('format') == 'prometheus':
+            return telemetry.prometheus_text(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+        return flask.jsonify(telemetry.snapshot())
 
 
 if __name__ == "__main__":
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name='eu-west-3'
-    )
-
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId='ezdehar-secret'
-        )
-    except ClientError as error:
-        raise error
-
-    secrets = json.loads(get_secret_value_response['SecretString'])
+    # The one Secrets Manager read, ObjectDetectionBot gets the cached values
+    secrets = aws.get_secret('ezdehar-secret')
     TELEGRAM_TOKEN = secrets['TELEGRAM_TOKEN']
     TELEGRAM_APP_URL = 'ezdehar-alb-57890755.eu-west-3.elb.amazonaws.com'
-    DYNAMODB_REGION = 'eu-west-3'
     DYNAMODB_TABLE_NAME = 'ezdehar-table'
-    dynamodb = boto3.resource('dynamodb', region_name=DYNAMODB_REGION)
-    dynamodb_table = dynamodb.Table(DYNAMODB_TABLE_NAME)
 
     # Create an instance of ObjectDetectionBot
     bot = ObjectDetectionBot(TELEGRAM_APP_URL)
 
+    # Webhook updates are handled by a bounded pool of background workers
+    dispatcher = UpdateDispatcher(bot.handle_message,
+                                  workers=int(os.environ.get('WEBHOOK_WORKERS', 8)),
+                                  max_queue=int(os.environ.get('WEBHOOK_QUEUE_SIZE', 1000)))
+
+    # Per-stage latency histograms and queue metrics, served on /metrics/
+    telemetry.configure('polybot', emf=os.environ.get('EMF', '0') == '1')
+    telemetry.register_gauges('dispatcher', dispatcher.metrics)
+    telemetry.register_gauges('sender', bot.sender.metrics)
+    telemetry.register_gauges('lanes', bot.lanes.metrics)
+
     # Call setup_routes to define routes
     setup_routes()
 
+    # From interpreter start to ready to serve
+    STARTUP_SECONDS = time.time() - STARTED_AT
+    telemetry.observe('startup', STARTUP_SECONDS)
+    logger.info(f'Polybot ready in {STARTUP_SECONDS:.2f}s')
+
     # Run the app
-    app.run(host='0.0.0.0', port=8443)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=8443, threaded=True)
\ No newline at end of file
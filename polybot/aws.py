@@ -0,0 +1,117 @@
+"""
+Shared AWS clients and secrets.
+
+The same module is used by polybot, yolo5 and metricStreamer (each service ships its own copy since
+they are built as separate images). Clients are process-wide singletons with a tuned connection
+pool and TCP keep-alive, so requests reuse warm TLS connections instead of paying for a new client
+and handshake every time. Secrets are cached with a TTL and refreshed in the background.
+"""
+import json
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+from loguru import logger
+
+REGION = 'eu-west-3'
+SECRET_TTL = 300
+
+CLIENT_CONFIG = Config(
+    region_name=REGION,
+    max_pool_connections=50,
+    tcp_keepalive=True,
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+)
+
+# boto3 sessions are not thread-safe, every client/resource creation goes through the lock
+_session = boto3.session.Session(region_name=REGION)
+_lock = threading.Lock()
+_clients = {}
+_local = threading.local()
+
+_secrets = {}  # secret name -> (value, fetched_at)
+_secrets_lock = threading.Lock()
+_refresher = None
+
+
+def client(service_name):
+    """Process-wide client for the service. boto3 clients are thread-safe and can be shared"""
+    service_client = _clients.get(service_name)
+    if service_client is None:
+        with _lock:
+            service_client = _clients.get(service_name)
+            if service_client is None:
+                service_client = _session.client(service_name, config=CLIENT_CONFIG)
+                _clients[service_name] = service_client
+    return service_client
+
+
+def resource(service_name):
+    """Per-thread resource for the service. boto3 resources are not thread-safe, so each thread gets its own"""
+    resources = getattr(_local, 'resources', None)
+    if resources is None:
+        resources = _local.resources = {}
+
+    service_resource = resources.get(service_name)
+    if service_resource is None:
+        with _lock:
+            service_resource = _session.resource(service_name, config=CLIENT_CONFIG)
+        resources[service_name] = service_resource
+    return service_resource
+
+
+def table(table_name):
+    """Per-thread DynamoDB Table"""
+    tables = getattr(_local, 'tables', None)
+    if tables is None:
+        tables = _local.tables = {}
+
+    dynamodb_table = tables.get(table_name)
+    if dynamodb_table is None:
+        dynamodb_table = tables[table_name] = resource('dynamodb').Table(table_name)
+    return dynamodb_table
+
+
+def get_secret(secret_name):
+    """
+    Returns the secret's JSON content. Values are cached for SECRET_TTL seconds and refreshed by a
+    background thread, so callers almost never wait on Secrets Manager.
+    """
+    entry = _secrets.get(secret_name)
+    if entry is not None and time.time() - entry[1] < SECRET_TTL:
+        return entry[0]
+
+    with _secrets_lock:
+        entry = _secrets.get(secret_name)
+        if entry is None or time.time() - entry[1] >= SECRET_TTL:
+            entry = _secrets[secret_name] = (_fetch_secret(secret_name), time.time())
+        _start_refresher()
+    return entry[0]
+
+
+def _fetch_secret(secret_name):
+    try:
+        secret_response = client('secretsmanager').get_secret_value(SecretId=secret_name)
+        return json.loads(secret_response['SecretString'])
+    except Exception as e:
+        logger.error(f"Error retrieving secret '{secret_name}': {e}")
+        raise
+
+
+def _start_refresher():
+    global _refresher
+    if _refresher is None:
+        _refresher = threading.Thread(target=_refresh_secrets, name='secrets-refresher', daemon=True)
+        _refresher.start()
+
+
+def _refresh_secrets():
+    while True:
+        time.sleep(SECRET_TTL / 2)
+        for secret_name in list(_secrets):
+            try:
+                _secrets[secret_name] = (_fetch_secret(secret_name), time.time())
+            except Exception:
+                # Keep serving the previous value, get_secret() retries synchronously once it expires
+                pass
@@ -3,8 +3,78 @@ from loguru import logger
 import os
 import time
 from telebot.types import InputFile
-import boto3
+import aws
+import telemetry
+from albums import AlbumCollector
+from lanes import INTERACTIVE, LaneRouter, parse_lanes
+from sender import OutboundSender
 import json
+import hashlib
+import io
+import requests
+from boto3.s3.transfer import TransferConfig
+
+TELEGRAM_FILE_URL = 'https://api.telegram.org/file/bot{0}/{1}'
+
+# Multipart above 8MB, at most max_concurrency parts of multipart_chunksize in memory at a time
+S3_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024,
+                                    max_concurrency=4)
+
+# The model letterboxes every image to 640px, larger renditions only cost bytes and decode time
+INFERENCE_SIZE = int(os.environ.get('INFERENCE_SIZE', 640))
+# Also downscale and re-encode the selected rendition before uploading it
+PRE_RESIZE = os.environ.get('PRE_RESIZE', '0') == '1'
+
+# Register the webhook (and upload the certificate) even when Telegram already has the right URL
+WEBHOOK_FORCE = os.environ.get('WEBHOOK_FORCE', '0') == '1'
+
+# Outgoing text messages are paced and coalesced by an OutboundSender, see sender.py
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_CHAT_BURST = int(os.environ.get('TELEGRAM_CHAT_BURST', 3))
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_SENDER_WORKERS = int(os.environ.get('TELEGRAM_SENDER_WORKERS', 4))
+COALESCE_MESSAGES = os.environ.get('COALESCE_MESSAGES', '1') == '1'
+
+# The photos of an album are sent as one job once no photo of the album arrived for this many seconds
+MEDIA_GROUP_WINDOW = float(os.environ.get('MEDIA_GROUP_WINDOW', 1))
+
+# Priority lanes, e.g. 'interactive=<queue url>:4,bulk=<queue url>:1' (the weights are the worker's business).
+# Lanes that are not listed, or all of them by default, use the SQS_QUEUE_NAME queue
+SQS_LANES = parse_lanes(os.environ.get('SQS_LANES', ''))
+# Chats sending more photos than this within FLOOD_WINDOW seconds go to the bulk lane
+FLOOD_LIMIT = int(os.environ.get('FLOOD_LIMIT', 20))
+FLOOD_WINDOW = float(os.environ.get('FLOOD_WINDOW', 60))
+
+def resize_photo(data, max_size, quality=90):
+    """Downscales the JPEG so its longest side is max_size and re-encodes it, smaller photos are kept as-is"""
+    # Only imported when PRE_RESIZE is on
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    if max(image.size) <= max_size:
+        return data
+
+    image.thumbnail((max_size, max_size))
+    resized = io.BytesIO()
+    image.convert('RGB').save(resized, format='JPEG', quality=quality)
+    return resized.getvalue()
+
+
+class HashingReader:
+    """File-like wrapper that computes the SHA-256 of everything read through it"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.sha256.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
 
 class Bot:
 
@@ -12,48 +82,73 @@ class Bot:
         # create a new instance of the TeleBot class.
         # all communication with Telegram servers are done using self.telegram_bot_client
         self.telegram_bot_client = telebot.TeleBot(token)
+        self.set_webhook(f'{telegram_chat_url}/{token}/')
+
+        # keep-alive session for file downloads
+        self.http = requests.Session()
 
-        # remove any existing webhooks configured in Telegram servers
-        self.telegram_bot_client.remove_webhook()
-        time.sleep(0.5)
+        # text messages are queued, rate limited and sent in the background
+        self.sender = OutboundSender(token, chat_rate=TELEGRAM_CHAT_RATE, chat_burst=TELEGRAM_CHAT_BURST,
+                                     global_rate=TELEGRAM_GLOBAL_RATE, workers=TELEGRAM_SENDER_WORKERS,
+                                     coalesce=COALESCE_MESSAGES)
 
-        # set the webhook URL
-        self.telegram_bot_client.set_webhook(url=f'{telegram_chat_url}/{token}/',
-                                             timeout=60,
-                                             certificate=open("YOURPUBLIC.pem", 'r'))
+    def set_webhook(self, webhook_url):
+        """
+        Registers the webhook, unless Telegram already delivers to this URL: every instance of a scale-out
+        would otherwise re-register it. set_webhook replaces the previous webhook, no need to remove it first.
+        """
+        current_url = self.telegram_bot_client.get_webhook_info().url
+        # Telegram reports the URL with its scheme
+        if not WEBHOOK_FORCE and current_url.split('://')[-1] == webhook_url.split('://')[-1]:
+            logger.info('Webhook already registered, skipping set_webhook')
+            return
 
-        logger.info(f'Telegram Bot information\n\n{self.telegram_bot_client.get_me()}')
+        with open("YOURPUBLIC.pem", 'r') as certificate:
+            self.telegram_bot_client.set_webhook(url=webhook_url, timeout=60, certificate=certificate)
+        logger.info('Webhook registered')
 
-    def send_text(self, chat_id, text):
-        self.telegram_bot_client.send_message(chat_id, text)
-        logger.info(f'Sent text message to chat_id {chat_id}: {text}')
+    def send_text(self, chat_id, text, kind=None):
+        """
+        Queues the message and returns right away, with a Future that completes once it is delivered.
+        :param kind: 'status' or 'result' lets the message be merged with a pending one of the same kind
+        """
+        return self.sender.send(chat_id, text, kind=kind)
 
     def send_text_with_quote(self, chat_id, text, quoted_msg_id):
-        self.telegram_bot_client.send_message(chat_id, text, reply_to_message_id=quoted_msg_id)
-        logger.info(f'Sent text message to chat_id {chat_id} with quote: {text}')
+        return self.sender.send(chat_id, text, reply_to=quoted_msg_id)
 
     def is_current_msg_photo(self, msg):
         return 'photo' in msg
 
-    def download_user_photo(self, msg):
+    @staticmethod
+    def select_photo_size(photo_sizes, min_size):
+        """
+        Telegram sends every photo in several renditions. Returns the smallest one whose longest side is at
+        least min_size, or the largest one when they are all smaller.
         """
-        Downloads the photos that sent to the Bot to `photos` directory (should be existed)
-        :return:
+        photo_sizes = sorted(photo_sizes, key=lambda p: max(p.get('width', 0), p.get('height', 0)))
+        for photo_size in photo_sizes:
+            if max(photo_size.get('width', 0), photo_size.get('height', 0)) >= min_size:
+                return photo_size
+        return photo_sizes[-1]
+
+    def open_user_photo(self, msg, photo_size=None):
+        """
+        Opens a streaming download of the photo that was sent to the Bot, nothing is read or written yet.
+        :param photo_size: the rendition to download, the largest one by default
+        :return: the Telegram file_path and the streaming response, to be closed by the caller
         """
         if not self.is_current_msg_photo(msg):
             raise RuntimeError(f'Message content of type \'photo\' expected')
 
-        file_info = self.telegram_bot_client.get_file(msg['photo'][-1]['file_id'])
-        data = self.telegram_bot_client.download_file(file_info.file_path)
-        folder_name = file_info.file_path.split('/')[0]
-
-        if not os.path.exists(folder_name):
-            os.makedirs(folder_name)
+        photo_size = photo_size or msg['photo'][-1]
+        file_info = self.telegram_bot_client.get_file(photo_size['file_id'])
+        file_url = TELEGRAM_FILE_URL.format(self.telegram_bot_client.token, file_info.file_path)
 
-        with open(file_info.file_path, 'wb') as photo:
-            photo.write(data)
-        logger.info(f'Downloaded photo from user with chat_id')
-        return file_info.file_path
+        response = self.http.get(file_url, stream=True, timeout=60)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return file_info.file_path, response
 
     def send_photo(self, chat_id, img_path):
         if not os.path.exists(img_path):
@@ -73,18 +168,23 @@ class Bot:
 
 class ObjectDetectionBot(Bot):
     def __init__(self, telegram_chat_url):
-        # Retrieve sensitive information from AWS Secrets Manager
-        secrets_manager = boto3.client('secretsmanager', region_name='eu-west-3')
+        # Retrieve sensitive information from AWS Secrets Manager (one cached read for all the values)
+        secrets = aws.get_secret('ezdehar-secret')
 
-        telegram_token = self.get_secret('TELEGRAM_TOKEN', secrets_manager)
-        self.s3_bucket_name = self.get_secret('S3_BUCKET_URL', secrets_manager)
-        self.sqs_queue_url = self.get_secret('SQS_QUEUE_NAME', secrets_manager)
+        telegram_token = secrets['TELEGRAM_TOKEN']
+        self.s3_bucket_name = secrets['S3_BUCKET_URL']
+        self.sqs_queue_url = secrets['SQS_QUEUE_NAME']
 
-        super().__init__(telegram_token, telegram_chat_url)  # Specify the region here
-        self.s3 = boto3.client('s3', region_name='eu-west-3')  # Specify the region here
-        self.sqs = boto3.client('sqs', region_name='eu-west-3')  # Specify the region here
+        super().__init__(telegram_token, telegram_chat_url)
+        self.s3 = aws.client('s3')
+        self.sqs = aws.client('sqs')
+        self.albums = AlbumCollector(self.send_album_job, window=MEDIA_GROUP_WINDOW)
+        self.lanes = LaneRouter(SQS_LANES, self.sqs_queue_url, flood_limit=FLOOD_LIMIT, flood_window=FLOOD_WINDOW)
 
-    def handle_message(self, msg):
+    def handle_message(self, msg, received_at=None, priority=INTERACTIVE):
+        # Timing spans of this message, carried to the worker in the SQS job
+        received_at = received_at or time.time()
+        timings = {}
 
         try:
             logger.info(f'Incoming message: {msg}')
@@ -96,23 +196,22 @@ class ObjectDetectionBot(Bot):
                                                   'I am here to help you with object detection in images. '
                                                   'Simply send an image, and I *the bot* will process it for you.')
 
+            elif self.is_current_msg_photo(msg) and msg.get('media_group_id'):
+                # One photo of an album, the whole album goes to the worker as one job
+                self.handle_album_photo(msg, received_at, timings, priority)
+
             elif self.is_current_msg_photo(msg):
-                self.send_text(chat_id, "👍 Great! I received a photo. Analyzing... 🔍")
-                img_path = self.download_user_photo(msg)
+                with telemetry.span('status_message', timings):
+                    self.send_text(chat_id, "👍 Great! I received a photo. Analyzing... 🔍", kind='status')
 
-                # Upload the photo to S3
-                s3_key = f'photos/{os.path.basename(img_path)}'
-                self.upload_to_s3(img_path, s3_key)
+                # Stream the photo from Telegram straight into S3
+                with telemetry.span('photo_upload', timings):
+                    photo = self.upload_photo(msg)
 
-                # Send a job to the SQS queue
-                job_message = {
-                    'photo_key': img_path,
-                    'chat_id': chat_id
-                }
-                self.send_to_sqs(json.dumps(job_message))
+                self.send_job(chat_id, [photo], received_at, timings, priority=priority)
 
                 # Send a message to the Telegram end-user
-                self.send_text(chat_id, '🤖 Your image is being processed. Please wait... ⏳')
+                self.send_text(chat_id, '🤖 Your image is being processed. Please wait... ⏳', kind='status')
             else:
                 self.send_text(chat_id, "🚫 I can only process photos. Please send me a photo. 📷")
         except Exception as e:
@@ -123,24 +222,107 @@ class ObjectDetectionBot(Bot):
             self.send_text(msg['chat']['id'],
                            'An error occurred while processing your request. Please try again later.')
         finally:
+            telemetry.observe('handle_message', time.time() - received_at)
             logger.info('Exiting handle_message.')
 
-    def upload_to_s3(self, img_path, s3_key):
+    def handle_album_photo(self, msg, received_at, timings, priority=INTERACTIVE):
+        chat_id = msg['chat']['id']
+        media_group_id = msg['media_group_id']
+
         try:
-            self.s3.upload_file(img_path, self.s3_bucket_name, os.path.basename(s3_key))
-        except Exception as e:
-            logger.error(f'Error uploading to S3: {e}')
+            if self.albums.begin(media_group_id, chat_id, received_at):
+                with telemetry.span('status_message', timings):
+                    self.send_text(chat_id, "👍 Great! I received your photos. Analyzing... 🔍", kind='status')
+
+            with telemetry.span('photo_upload', timings):
+                photo = self.upload_photo(msg)
+        except Exception:
+            self.albums.abort(media_group_id)
             raise
-        return s3_key
 
-    def send_to_sqs(self, message_body):
-        self.sqs.send_message(QueueUrl=self.sqs_queue_url, MessageBody=message_body)
+        photo['timings'] = timings
+        photo['priority'] = priority
+        if not self.albums.complete(media_group_id, photo):
+            # The rest of the album is already on its way, this photo gets a job of its own
+            self.send_album_job(media_group_id, chat_id, [photo], received_at)
 
-    @staticmethod
-    def get_secret(value, secrets_manager):
+    def send_album_job(self, media_group_id, chat_id, photos, received_at):
+        # The album is as slow as its slowest photo
+        timings = {}
+        for photo in photos:
+            for stage, seconds in photo.pop('timings', {}).items():
+                timings[stage] = max(seconds, timings.get(stage, 0))
+
+        self.send_job(chat_id, photos, received_at, timings, priority=photos[0].get('priority', INTERACTIVE),
+                      media_group_id=media_group_id)
+        self.send_text(chat_id, f'🤖 Your {len(photos)} images are being processed. Please wait... ⏳', kind='status')
+
+    def upload_photo(self, msg):
+        img_path, photo_hash = self.stream_photo_to_s3(msg)
+        return {
+            'message_id': msg.get('message_id'),
+            'photo_key': img_path,
+            'photo_hash': photo_hash,
+            'original_file_id': msg['photo'][-1]['file_id'],
+        }
+
+    def send_job(self, chat_id, photos, received_at, timings, priority=INTERACTIVE, media_group_id=None):
+        """
+        Sends one job to the SQS queue of its lane for a photo, or for all the photos of an album. The hashes
+        let the worker reuse the results of duplicate photos, the chat_id lets it cap the jobs of one chat.
+        """
+        priority, queue_url = self.lanes.route(chat_id, priority, photos=len(photos))
+        job_message = {
+            'photo_key': photos[0]['photo_key'],
+            'chat_id': chat_id,
+            'priority': priority,
+            'photo_hash': photos[0]['photo_hash'],
+            'original_file_id': photos[0]['original_file_id'],
+            'received_at': received_at,
+            'timings': timings
+        }
+        if len(photos) > 1:
+            # Workers that predate albums only see the first photo, through the fields above
+            job_message.update({
+                'media_group_id': media_group_id,
+                'photo_keys': [photo['photo_key'] for photo in photos],
+                'photo_hashes': [photo['photo_hash'] for photo in photos],
+                'original_file_ids': [photo['original_file_id'] for photo in photos],
+            })
+
+        with telemetry.span('sqs_send'):
+            prediction_id = self.send_to_sqs(json.dumps(job_message), queue_url)
+        logger.info(f'prediction: {prediction_id}. {len(photos)} photos, {priority} lane, '
+                    f'polybot timings: {json.dumps(timings)}')
+        return prediction_id
+
+    def stream_photo_to_s3(self, msg):
+        """
+        Pipes the Telegram file download into an S3 upload, without a local file. upload_fileobj switches to
+        a multipart upload for large files, and memory stays bounded by the transfer chunk size.
+        With PRE_RESIZE the (already small) selected rendition is read into memory to be downscaled.
+        """
+        # No need to move more pixels than the model looks at
+        photo_size = self.select_photo_size(msg['photo'], INFERENCE_SIZE)
+        img_path, response = self.open_user_photo(msg, photo_size)
+
+        # The full-size original can be fetched from Telegram on demand
+        extra_args = {'Metadata': {'original-file-id': msg['photo'][-1]['file_id']}}
+
+        photo = HashingReader(response.raw)
         try:
-            get_secret_value_response = secrets_manager.get_secret_value(SecretId='ezdehar-secret')
-            return json.loads(get_secret_value_response['SecretString'])[value]
+            with response:
+                body = io.BytesIO(resize_photo(photo.read(), INFERENCE_SIZE)) if PRE_RESIZE else photo
+                self.s3.upload_fileobj(body, self.s3_bucket_name, os.path.basename(img_path),
+                                       ExtraArgs=extra_args, Config=S3_TRANSFER_CONFIG)
         except Exception as e:
-            logger.error(f"Error retrieving secret '{value}': {e}")
+            logger.error(f'Error uploading to S3: {e}')
             raise
+
+        photo_hash = photo.hexdigest()
+        logger.info(f'Streamed photo {img_path} to S3, sha256 {photo_hash}')
+        return img_path, photo_hash
+
+    def send_to_sqs(self, message_body, queue_url=None):
+        """Returns the MessageId, which the worker uses as the prediction id"""
+        return self.sqs.send_message(QueueUrl=queue_url or self.sqs_queue_url, MessageBody=message_body)['MessageId']
@@ -0,0 +1,77 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+from loguru import logger
+
+import telemetry
+
+
+class UpdateDispatcher:
+    """
+    Hands incoming Telegram messages to a bounded pool of worker threads, so the webhook can answer
+    right away instead of blocking on downloads, S3, SQS and replies.
+
+    Telegram redelivers an update when the webhook answers late or fails, so updates are deduplicated
+    on their update_id (the last `dedup_size` ids are remembered).
+    """
+
+    def __init__(self, handler, workers=8, max_queue=1000, dedup_size=10000):
+        self.handler = handler
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dedup_size = dedup_size
+
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._in_progress = 0
+        self._counters = {'received': 0, 'duplicates': 0, 'rejected': 0, 'processed': 0, 'failed': 0}
+
+        for n in range(workers):
+            threading.Thread(target=self._work, name=f'update-worker-{n}', daemon=True).start()
+
+    def submit(self, message, update_id=None, priority=None):
+        """
+        Queues the message, returns False when the queue is full and the update should be retried later.
+        :param priority: passed on to the handler with the message
+        """
+        with self._lock:
+            self._counters['received'] += 1
+            if update_id is not None:
+                if update_id in self._seen:
+                    self._counters['duplicates'] += 1
+                    logger.info(f'Skipping duplicate update {update_id}')
+                    return True
+                self._seen[update_id] = True
+                if len(self._seen) > self.dedup_size:
+                    self._seen.popitem(last=False)
+
+        try:
+            self.queue.put_nowait((message, time.time(), priority))
+        except queue.Full:
+            with self._lock:
+                self._counters['rejected'] += 1
+                # Forget the id, so Telegram's redelivery of this update is accepted
+                self._seen.pop(update_id, None)
+            logger.warning(f'Update queue is full ({self.queue.maxsize}), rejecting update {update_id}')
+            return False
+        return True
+
+    def metrics(self):
+        with self._lock:
+            return {**self._counters, 'queue_depth': self.queue.qsize(), 'in_progress': self._in_progress}
+
+    def _work(self):
+        while True:
+            message, received_at, priority = self.queue.get()
+            telemetry.observe('webhook_queue_wait', time.time() - received_at)
+            with self._lock:
+                self._in_progress += 1
+            try:
+                self.handler(message, received_at=received_at, priority=priority)
+                outcome = 'processed'
+            except Exception as e:
+                logger.error(f'Error handling update: {e}')
+                outcome = 'failed'
+            with self._lock:
+                self._in_progress -= 1
+                self._counters[outcome] += 1
@@ -0,0 +1,44 @@
+"""
+Decoding of the prediction labels stored in DynamoDB by the yolo5 worker (see yolo5/labels.py).
+
+    legacy    'labels' is a list of {'class', 'cx', 'cy', 'width', 'height'} maps
+    columnar  'labels' is a map of parallel lists: {'class': [...], 'cx': [...], 'cy': [...], ...}
+    packed    'labels' is a binary attribute, LABEL_STRUCT per label with uint16-quantized coordinates,
+              and 'class_names' holds the names the class indexes refer to
+
+Items written by newer workers also hold 'counts', the number of objects per class.
+"""
+import struct
+
+COORDINATES = ('cx', 'cy', 'width', 'height')
+
+# class index, cx, cy, width, height
+LABEL_STRUCT = struct.Struct('<B4H')
+QUANTIZATION_SCALE = 65535
+
+
+def count_classes(labels):
+    counts = {}
+    for label in labels:
+        counts[label['class']] = counts.get(label['class'], 0) + 1
+    return counts
+
+
+def decode_labels(item):
+    """Returns the labels of a stored item as a legacy list of maps, whatever format they were stored in"""
+    label_format = item.get('label_format', 'legacy')
+    labels = item.get('labels', [])
+
+    if label_format == 'columnar':
+        return [
+            {'class': name, **{c: float(labels[c][i]) for c in COORDINATES}}
+            for i, name in enumerate(labels['class'])
+        ]
+    if label_format == 'packed':
+        class_names = item['class_names']
+        packed = getattr(labels, 'value', labels)  # boto3 returns binary attributes as Binary
+        return [
+            {'class': class_names[values[0]], **{c: v / QUANTIZATION_SCALE for c, v in zip(COORDINATES, values[1:])}}
+            for values in LABEL_STRUCT.iter_unpack(bytes(packed))
+        ]
+    return labels
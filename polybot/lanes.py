@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+
+def parse_lanes(spec):
+    """
+    'interactive=<queue url>:4,bulk=<queue url>:1' -> {'interactive': <queue url>, 'bulk': <queue url>}.
+    The same SQS_LANES value configures the worker, which also reads the weights; Polybot ignores them.
+    """
+    lanes = {}
+    for entry in filter(None, (entry.strip() for entry in spec.split(','))):
+        name, _, queue_url = entry.partition('=')
+        queue_url, _, weight = queue_url.rpartition(':')
+        if not weight.isdigit():
+            # No weight, the colon belongs to the URL
+            queue_url = f'{queue_url}:{weight}' if queue_url else weight
+        lanes[name.strip()] = queue_url
+    return lanes
+
+
+class LaneRouter:
+    """
+    Picks the SQS queue (lane) of a job from its priority: updates from users are interactive, load tests
+    are bulk. A chat that sends more than `flood_limit` photos within `flood_window` seconds is demoted
+    to the bulk lane, so one chat flooding photos can't push everybody else's latency up.
+
+    Priorities without a lane of their own go to the default queue.
+    """
+
+    def __init__(self, lanes, default_queue, flood_limit=20, flood_window=60, max_chats=10000):
+        self.lanes = lanes
+        self.default_queue = default_queue
+        self.flood_limit = flood_limit
+        self.flood_window = flood_window
+        self.max_chats = max_chats
+
+        self._recent = OrderedDict()  # chat_id -> deque of (timestamp, photos)
+        self._lock = threading.Lock()
+        self._counters = {INTERACTIVE: 0, BULK: 0, 'demoted': 0}
+
+    def route(self, chat_id, priority=INTERACTIVE, photos=1):
+        """Returns the effective priority and the queue URL of the job"""
+        if priority == INTERACTIVE and self._flooding(chat_id, photos):
+            priority = BULK
+            self._count('demoted')
+        self._count(priority)
+        return priority, self.lanes.get(priority, self.default_queue)
+
+    def metrics(self):
+        with self._lock:
+            return {**self._counters, 'chats': len(self._recent)}
+
+    def _flooding(self, chat_id, photos):
+        now = time.time()
+        with self._lock:
+            recent = self._recent.get(chat_id)
+            if recent is None:
+                recent = self._recent[chat_id] = deque()
+                if len(self._recent) > self.max_chats:
+                    self._recent.popitem(last=False)
+            self._recent.move_to_end(chat_id)
+
+            while recent and recent[0][0] < now - self.flood_window:
+                recent.popleft()
+            recent.append((now, photos))
+            return sum(count for _, count in recent) > self.flood_limit
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + 1
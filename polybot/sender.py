@@ -0,0 +1,217 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+from loguru import logger
+
+import telemetry
+
+TELEGRAM_API_URL = 'https://api.telegram.org/bot{0}/{1}'
+# Longest text Telegram accepts in one message, coalescing never goes past it
+MAX_MESSAGE_LENGTH = 4096
+# Kinds of messages that may be merged with a pending message of the same kind to the same chat
+COALESCED_KINDS = ('status', 'result')
+
+
+class TokenBucket:
+    """`rate` tokens per second, at most `burst` saved up"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def delay(self, now):
+        """Seconds until a token is available, 0 when one is available now"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class PendingMessage:
+
+    def __init__(self, chat_id, text, kind, reply_to):
+        self.chat_id = chat_id
+        self.text = text
+        self.kind = kind
+        self.reply_to = reply_to
+        self.queued_at = time.time()
+        self.future = Future()
+
+
+class OutboundSender:
+    """
+    Queue of outgoing Telegram text messages, sent by a small pool of threads over one keep-alive session.
+
+    Sends are paced by a token bucket per chat and a global one, to stay under Telegram's limits (about one
+    message per second per chat and 30 per second overall) instead of running into 429s during bursts.
+    Messages to the same chat are sent one at a time, in order, and chats take turns.
+
+    While a message waits for its chat's bucket, a later message of the same coalescable kind to that chat
+    is appended to it (a status text it already holds is dropped), so a user sending ten photos at once gets
+    a few combined replies.
+    A 429 pauses all sends for the `retry_after` seconds Telegram asks for, other failures are retried
+    with exponential backoff.
+
+    send() returns a Future that completes when the message is delivered (or finally failed).
+    """
+
+    def __init__(self, token, chat_rate=1.0, chat_burst=3, global_rate=30.0, workers=4, coalesce=True,
+                 max_retries=5, backoff=0.5, max_chats=10000):
+        self.url = TELEGRAM_API_URL.format(token, 'sendMessage')
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.coalesce = coalesce
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_chats = max_chats
+
+        self.session = requests.Session()
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='telegram-sender')
+
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = OrderedDict()
+        self._pending = OrderedDict()  # chat_id -> deque of PendingMessage, in turn order
+        self._busy = set()  # chats with a message being sent
+        self._paused_until = 0.0  # monotonic time, set by a 429
+        self._cond = threading.Condition()
+        self._counters = {'queued': 0, 'coalesced': 0, 'sent': 0, 'retried': 0, 'rate_limited': 0, 'failed': 0}
+
+        threading.Thread(target=self._schedule, name='telegram-scheduler', daemon=True).start()
+
+    def send(self, chat_id, text, kind=None, reply_to=None):
+        with self._cond:
+            chat_queue = self._pending.setdefault(chat_id, deque())
+            if self.coalesce and kind in COALESCED_KINDS and reply_to is None:
+                merged = self._merge(chat_queue, text, kind)
+                if merged is not None:
+                    self._counters['coalesced'] += 1
+                    return merged.future
+
+            message = PendingMessage(chat_id, text, kind, reply_to)
+            chat_queue.append(message)
+            self._counters['queued'] += 1
+            self._cond.notify()
+        return message.future
+
+    def metrics(self):
+        with self._cond:
+            pending = sum(len(chat_queue) for chat_queue in self._pending.values())
+            return {**self._counters, 'pending': pending, 'busy_chats': len(self._busy)}
+
+    @staticmethod
+    def _merge(chat_queue, text, kind):
+        """The pending message `text` was merged into, None when there is none to merge into"""
+        for message in reversed(chat_queue):
+            if message.kind != kind or message.reply_to is not None:
+                continue
+            # A repeated status text says nothing new, but two identical results are two photos
+            if kind == 'status' and text in message.text.split('\n'):
+                return message
+            if len(message.text) + 1 + len(text) <= MAX_MESSAGE_LENGTH:
+                message.text = f'{message.text}\n{text}'
+                return message
+            return None
+        return None
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._chat_buckets) > self.max_chats:
+                self._chat_buckets.popitem(last=False)
+        self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _schedule(self):
+        with self._cond:
+            while True:
+                wait = self._dispatch_ready()
+                self._cond.wait(wait)
+
+    def _dispatch_ready(self):
+        """Starts every send the buckets allow, returns how long to wait before trying again (None: until notified)"""
+        wait = None
+        for chat_id in list(self._pending):
+            chat_queue = self._pending[chat_id]
+            if not chat_queue:
+                del self._pending[chat_id]
+                continue
+            if chat_id in self._busy:
+                continue
+
+            now = time.monotonic()
+            delay = max(self._paused_until - now, self._chat_bucket(chat_id).delay(now),
+                        self._global_bucket.delay(now))
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+
+            self._chat_bucket(chat_id).consume()
+            self._global_bucket.consume()
+            message = chat_queue.popleft()
+            self._busy.add(chat_id)
+            # The chat goes to the back of the line
+            self._pending.move_to_end(chat_id)
+            self._executor.submit(self._deliver, message)
+        return wait
+
+    def _deliver(self, message):
+        telemetry.observe('outbound_queue_wait', time.time() - message.queued_at)
+        try:
+            self._send_with_retries(message)
+            message.future.set_result(True)
+            self._count('sent')
+        except Exception as e:
+            logger.error(f'Error sending message to chat_id {message.chat_id}: {e}')
+            message.future.set_exception(e)
+            self._count('failed')
+        finally:
+            with self._cond:
+                self._busy.discard(message.chat_id)
+                self._cond.notify()
+
+    def _send_with_retries(self, message):
+        payload = {'chat_id': message.chat_id, 'text': message.text}
+        if message.reply_to is not None:
+            payload['reply_to_message_id'] = message.reply_to
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                with telemetry.span('telegram_send'):
+                    response = self.session.post(self.url, json=payload, timeout=30)
+            except requests.RequestException as e:
+                error, retry_after = e, self.backoff * 2 ** attempt
+            else:
+                if response.ok:
+                    logger.info(f'Sent text message to chat_id {message.chat_id}: {message.text}')
+                    return
+                if response.status_code == 429:
+                    self._count('rate_limited')
+                    parameters = response.json().get('parameters', {})
+                    retry_after = parameters.get('retry_after', self.backoff * 2 ** attempt)
+                    # Flood control applies to the whole bot, not just this chat
+                    with self._cond:
+                        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                elif response.status_code >= 500:
+                    retry_after = self.backoff * 2 ** attempt
+                else:
+                    # Blocked by the user, chat not found, bad request: retrying won't help
+                    response.raise_for_status()
+                error = RuntimeError(f'Telegram answered {response.status_code}: {response.text}')
+
+            if attempt == self.max_retries:
+                raise error
+            self._count('retried')
+            time.sleep(retry_after)
+
+    def _count(self, counter):
+        with self._cond:
+            self._counters[counter] += 1
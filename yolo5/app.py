@@ -1,123 +1,531 @@
 import time
+# Taken before the heavy imports, so the reported startup time includes them
+STARTED_AT = time.time()
+import io
 from pathlib import Path
-from detect import run
-import yaml
+import cv2
+import numpy as np
+from labels import count_classes, encode_labels
+from lanes import ChatLimiter, LanePoller, parse_lanes
+from pipeline import Pipeline, Stage
+from result_cache import ResultCache
+from result_writer import ResultWriter
+from supervisor import plan_workers, run_supervisor
 from loguru import logger
 import os
-import boto3
+import aws
+import telemetry
 import requests
 import json
 from decimal import Decimal
 
-# Retrieve sensitive information from AWS Secrets Manager
-secrets_manager = boto3.client('secretsmanager', region_name='eu-west-3')
+polybot_url = 'https://ezdehar-alb-57890755.eu-west-3.elb.amazonaws.com/results/'  # Replace with the actual ALB URL of Polybot
+polybot_session = requests.Session()
+
+# Set by setup() in the process that polls SQS. Nothing talks to AWS at import time, so the supervisor
+# process and the spawned worker processes import this module quickly
+images_bucket = None
+queue_name = None
+sqs_client = None
+lane_poller = None
+
+# Micro-batching: SQS returns at most 10 messages per receive call
+BATCH_SIZE = min(int(os.environ.get('BATCH_SIZE', 10)), 10)
+BATCH_MAX_WAIT = float(os.environ.get('BATCH_MAX_WAIT', 1))
+
+# Keep images in memory from S3 download to annotated upload, nothing is written under photos/ or static/data/
+ZERO_DISK = os.environ.get('ZERO_DISK', '1') == '1'
+
+# Pipelined mode: concurrent download/inference/upload/store/notify stages with bounded in-flight jobs
+PIPELINE = os.environ.get('PIPELINE', '1') == '1'
+MAX_IN_FLIGHT = int(os.environ.get('MAX_IN_FLIGHT', 32))
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 4))
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 4))
+DYNAMODB_WORKERS = int(os.environ.get('DYNAMODB_WORKERS', 2))
+POLYBOT_WORKERS = int(os.environ.get('POLYBOT_WORKERS', 2))
+
+# Priority lanes polled with weighted fair scheduling, e.g. 'interactive=<queue url>:4,bulk=<queue url>:1'.
+# By default there is a single lane, the SQS_QUEUE_NAME queue
+SQS_LANES = os.environ.get('SQS_LANES', '')
+# Jobs of one chat in flight at the same time (0: no cap), the chat's other messages are put back
+# in their queue for CHAT_DEFER_SECONDS. The cap is per worker process: a chat can have up to
+# MAX_PER_CHAT x worker processes (see WORKERS) x instances jobs in flight across the group
+MAX_PER_CHAT = int(os.environ.get('MAX_PER_CHAT', 4))
+CHAT_DEFER_SECONDS = int(os.environ.get('CHAT_DEFER_SECONDS', 10))
+
+chat_limiter = ChatLimiter(MAX_PER_CHAT)
+
+# DynamoDB results are buffered and written with BatchWriteItem, see ResultWriter
+DYNAMODB_TABLE_NAME = 'ezdehar-table'
+DYNAMODB_BATCH_SIZE = int(os.environ.get('DYNAMODB_BATCH_SIZE', 25))
+DYNAMODB_FLUSH_INTERVAL = float(os.environ.get('DYNAMODB_FLUSH_INTERVAL', 0.5))
+# Seconds ack waits for a result to be written, past it the message is left for SQS to redeliver
+DYNAMODB_STORE_TIMEOUT = float(os.environ.get('DYNAMODB_STORE_TIMEOUT', 30))
+# How labels are stored: 'legacy', 'columnar' or 'packed', see labels.py
+LABEL_FORMAT = os.environ.get('LABEL_FORMAT', 'legacy')
+
+# Created by setup()
+result_writer = None
+
+# Results of already seen photos, keyed by the photo hash Polybot puts in the job
+RESULT_CACHE = os.environ.get('RESULT_CACHE', '1') == '1'
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 10000))
+HASH_INDEX_TABLE_NAME = os.environ.get('HASH_INDEX_TABLE_NAME', 'ezdehar-photo-hashes')
+
+# Created by setup(), None when RESULT_CACHE is off
+result_cache = None
+
+# 'torch' (fp32 yolov5s.pt), 'onnx' (fp32 ONNX Runtime) or 'onnx-int8' (dynamically quantized ONNX Runtime)
+INFERENCE_BACKEND = os.environ.get('INFERENCE_BACKEND', 'torch')
+
+# Model replicas: one worker process per THREADS_PER_WORKER cores with WORKERS=auto
+WORKERS = os.environ.get('WORKERS', 'auto')
+THREADS_PER_WORKER = int(os.environ.get('THREADS_PER_WORKER', 2))
+
+# Per-stage latency histograms are served on METRICS_PORT (+ the worker index with several worker processes)
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9100))
+# Also print every timing as a CloudWatch Embedded Metric Format line
+EMF = os.environ.get('EMF', '0') == '1'
+
+# Created and warmed up once per worker process in run_worker(), before polling, reused for every message
+detector = None
 
-def get_secret(secret_name):
-    try:
-        secret_response = secrets_manager.get_secret_value(SecretId=secret_name)
-        return json.loads(secret_response['SecretString'])
-    except Exception as e:
-        logger.error(f"Error retrieving secret '{secret_name}': {e}")
-        raise
 
-secrets = get_secret('ezdehar-secret')
+def consume():
+    while True:
+        jobs = admit(receive_batch())
+
+        if jobs:
+            process_batch(jobs)
+
+
+def consume_pipelined():
+    pipeline = Pipeline(
+        receive=lambda max_messages: admit(receive_batch(max_messages)),
+        stages=[
+            Stage('download', prepare_job, workers=DOWNLOAD_WORKERS),
+            Stage('inference', infer_jobs, batch_size=BATCH_SIZE),
+            Stage('upload', upload_results, workers=UPLOAD_WORKERS),
+            Stage('dynamodb', store_results, workers=DYNAMODB_WORKERS),
+            Stage('polybot', notify_jobs, workers=POLYBOT_WORKERS, batch_size=BATCH_SIZE),
+            Stage('ack', ack_jobs, batch_size=10),
+        ],
+        max_in_flight=MAX_IN_FLIGHT,
+        max_receive=BATCH_SIZE,
+        on_done=lambda job: chat_limiter.release(job['chat_id']),
+    )
+    pipeline.run()
+
+
+def receive_batch(max_messages=BATCH_SIZE):
+    """
+    Collects up to max_messages messages. Long polls until the first message arrives, then keeps
+    receiving for at most BATCH_MAX_WAIT seconds to fill the batch.
+    """
+    messages = []
+    deadline = None
+
+    while len(messages) < max_messages:
+        if deadline is None:
+            wait_time = 5
+        else:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            wait_time = int(remaining)
 
-images_bucket = secrets['BUCKET_NAME']
-queue_name = secrets['SQS_QUEUE_NAME']
-polybot_url = 'https://ezdehar-alb-57890755.eu-west-3.elb.amazonaws.com/results/'  # Replace with the actual ALB URL of Polybot
+        received = lane_poller.receive(max_messages - len(messages), wait_time)
 
-sqs_client = boto3.client('sqs', region_name='eu-west-3')
+        if not received:
+            break
 
-with open("data/coco128.yaml", "r") as stream:
-    names = yaml.safe_load(stream)['names']
+        messages += received
+        if deadline is None:
+            deadline = time.time() + BATCH_MAX_WAIT
 
+    return messages
 
 
-def consume():
-    while True:
-        response = sqs_client.receive_message(QueueUrl=queue_name, MaxNumberOfMessages=1, WaitTimeSeconds=5)
+def admit(messages):
+    """
+    Parses the messages into jobs and takes a per-chat slot for every job. Messages of a chat that already
+    has MAX_PER_CHAT jobs in flight are made visible again in CHAT_DEFER_SECONDS, for the worker (or another
+    one) to pick up later. Malformed messages are deleted, they would fail the same way on every delivery.
+    """
+    admitted = []
+    try:
+        for message in messages:
+            try:
+                job = parse_job(message)
+            except Exception as e:
+                logger.error(f'prediction: {message["MessageId"]}. Malformed message, deleting it: {e}')
+                delete_message(message)
+                continue
+
+            if chat_limiter.try_acquire(job['chat_id']):
+                sent_timestamp = message.get('Attributes', {}).get('SentTimestamp')
+                if sent_timestamp:
+                    telemetry.observe('sqs_wait', max(0.0, time.time() - int(sent_timestamp) / 1000),
+                                      job['timings'])
+                admitted.append(job)
+                continue
+
+            logger.info(f'prediction: {job["prediction_id"]}. Chat {job["chat_id"]} is at its in-flight cap, '
+                        f'deferring')
+            defer_message(message)
+    except Exception:
+        # The caller gets no job to release the slots of
+        for job in admitted:
+            chat_limiter.release(job['chat_id'])
+        raise
+    return admitted
 
-        if 'Messages' in response:
-            message = response['Messages'][0]['Body']
-            receipt_handle = response['Messages'][0]['ReceiptHandle']
 
-            # Use the ReceiptHandle as a prediction UUID
-            prediction_id = response['Messages'][0]['MessageId']
+def defer_message(message):
+    try:
+        sqs_client.change_message_visibility(QueueUrl=message.get('QueueUrl', queue_name),
+                                             ReceiptHandle=message['ReceiptHandle'],
+                                             VisibilityTimeout=CHAT_DEFER_SECONDS)
+    except Exception as e:
+        # It comes back after the queue's visibility timeout instead
+        logger.error(f'prediction: {message["MessageId"]}. Error deferring message: {e}')
 
-            logger.info(f'prediction: {prediction_id}. start processing')
 
-            # Receives parameters from the message
-            message_body = json.loads(message)
-            img_name = message_body.get('photo_key')
-            chat_id = message_body.get('chat_id')
-           # original_img_path = f'{img_name}'
-            logger.info(f'S3 Bucket: {images_bucket}, Image Name: {img_name}')
+def delete_message(message):
+    try:
+        sqs_client.delete_message(QueueUrl=message.get('QueueUrl', queue_name), ReceiptHandle=message['ReceiptHandle'])
+    except Exception as e:
+        # It comes back after the queue's visibility timeout and is dropped again
+        logger.error(f'prediction: {message["MessageId"]}. Error deleting message: {e}')
+
+
+def parse_job(message):
+    # Receives parameters from the message
+    message_body = json.loads(message['Body'])
+
+    # A job is one photo, or all the photos of an album
+    photo_keys = message_body.get('photo_keys') or [message_body.get('photo_key')]
+    photo_hashes = message_body.get('photo_hashes') or [message_body.get('photo_hash')] * len(photo_keys)
+
+    job = {
+        # Use the MessageId as a prediction UUID
+        'prediction_id': message['MessageId'],
+        'receipt_handle': message['ReceiptHandle'],
+        # The lane the message came from, it is deleted from there
+        'queue_url': message.get('QueueUrl', queue_name),
+        'lane': message.get('Lane'),
+        'priority': message_body.get('priority'),
+        'chat_id': message_body.get('chat_id'),
+        'media_group_id': message_body.get('media_group_id'),
+        'photos': [{'img_name': img_name, 'photo_hash': photo_hash}
+                   for img_name, photo_hash in zip(photo_keys, photo_hashes)],
+        # Timing spans of this prediction, starting with the ones Polybot measured before sending the job
+        'received_at': message_body.get('received_at'),
+        'timings': {f'polybot_{stage}': seconds for stage, seconds in message_body.get('timings', {}).items()},
+        'started': time.perf_counter(),
+    }
+    return job
+
+
+def process_batch(parsed):
+    try:
+        process_jobs(parsed)
+    finally:
+        for job in parsed:
+            chat_limiter.release(job['chat_id'])
+
+
+def process_jobs(parsed):
+    jobs = []
+    for job in parsed:
+        try:
+            prepare_job(job)
+            jobs.append(job)
+        except Exception as e:
+            # The message stays in the queue and is retried after its visibility timeout
+            logger.error(f'prediction: {job["prediction_id"]}. Error preparing job: {e}')
+
+    if not jobs:
+        return
+
+    infer_jobs(jobs)
+
+    stored = []
+    for job in jobs:
+        try:
+            upload_results(job)
+            store_results(job)
+            stored.append(job)
+        except Exception as e:
+            logger.error(f'prediction: {job["prediction_id"]}. Error publishing results: {e}')
 
-            original_img_path = download_from_s3(img_name, prediction_id)
+    try:
+        notify_jobs(stored)
+    except Exception as e:
+        logger.error(f'Error publishing results of {len(stored)} predictions: {e}')
+        return
 
-            logger.info(f'prediction: {prediction_id}/{original_img_path}. Download img completed')
+    # Delete the messages from the queue as the jobs are considered as DONE
+    ack_jobs(stored)
 
-            # Predicts the objects in the image
-            run(
-                weights='yolov5s.pt',
-                data='data/coco128.yaml',
-                source=original_img_path,
-                project='static/data',
-                name=prediction_id,
-                save_txt=True
-            )
 
-            logger.info(f'prediction: {prediction_id}/{original_img_path}. done')
+def prepare_job(job):
+    logger.info(f'prediction: {job["prediction_id"]}. start processing')
+    for index, photo in enumerate(job['photos']):
+        prepare_photo(job, photo, index)
 
-            # This is the path for the predicted image with labels
-            predicted_img_path = Path(f'static/data/{prediction_id}/{original_img_path}')
 
-            # Upload the predicted image to S3 (do not override the original image)
-            # Debug prints
-            print(f"Before upload_to_s3: Local file exists: {os.path.exists(predicted_img_path)}")
-            print(f"Local directory exists: {os.path.exists(predicted_img_path.parent)}")
+def original_img_path(job, index):
+    # A single photo is named after the prediction, the photos of an album are numbered
+    if len(job['photos']) == 1:
+        return Path(f'photos/{job["prediction_id"]}.jpg')
+    return Path(f'photos/{job["prediction_id"]}-{index}.jpg')
 
-            upload_to_s3(predicted_img_path, f'predicted_images/{prediction_id}/{original_img_path}')
 
-            # Debug prints
-            print(f"After upload_to_s3: Local file exists: {os.path.exists(predicted_img_path)}")
+def prepare_photo(job, photo, index):
+    prediction_id = job['prediction_id']
+    logger.info(f'S3 Bucket: {images_bucket}, Image Name: {photo["img_name"]}')
+    photo['original_img_path'] = original_img_path(job, index)
 
-            # Parse prediction labels and create a summary
-            pred_summary_path = Path(f'static/data/{prediction_id}/labels/{original_img_path.name.split(".")[0]}.txt')
+    # A photo that was already processed skips download, inference and upload
+    if result_cache is not None and photo['photo_hash']:
+        with telemetry.span('cache_lookup', job['timings'], prediction_id):
+            cached = result_cache.get(photo['photo_hash'])
+        if cached is not None:
+            logger.info(f'prediction: {prediction_id}. Result cache hit for photo {photo["photo_hash"]}')
+            photo['cached'] = cached
+            return
 
+    with telemetry.span('download', job['timings'], prediction_id):
+        if ZERO_DISK:
+            photo['image'] = download_image(photo['img_name'])
+        else:
+            download_from_s3(photo['img_name'], photo['original_img_path'].stem)
+            photo['image'] = cv2.imread(str(photo['original_img_path']))
+
+    logger.info(f'prediction: {prediction_id}/{photo["original_img_path"]}. Download img completed')
+
+
+def infer_jobs(jobs):
+    # Forward passes of at most BATCH_SIZE images, the photos of an album always go in the same pass
+    chunk, size = [], 0
+    for job in jobs:
+        photos = [photo for photo in job['photos'] if 'cached' not in photo]
+        if not photos:
+            continue
+        if chunk and size + len(photos) > BATCH_SIZE:
+            predict_photos(chunk)
+            chunk, size = [], 0
+        chunk.append((job, photos))
+        size += len(photos)
+
+    if chunk:
+        predict_photos(chunk)
+
+
+def predict_photos(chunk):
+    """Predicts the objects in all the photos of the (job, photos) pairs with one forward pass"""
+    start = time.perf_counter()
+    detections = iter(detector.predict_batch([photo['image'] for _, photos in chunk for photo in photos]))
+    elapsed = time.perf_counter() - start
+
+    for job, photos in chunk:
+        for photo in photos:
+            photo['detections'] = next(detections)
+        telemetry.observe('inference', elapsed, job['timings'], job['prediction_id'])
+        logger.info(f'prediction: {job["prediction_id"]}. done, {len(photos)} images')
+
+
+def upload_results(job):
+    for photo in job['photos']:
+        upload_photo_results(job, photo)
+
+    # One summary for the job, the labels of all the photos of an album together
+    labels = [label for photo in job['photos'] for label in photo['labels']]
+    first = job['photos'][0]
+
+    if labels:
+        logger.info(f'prediction: {job["prediction_id"]}. prediction summary:\n\n{labels}')
+
+        job['prediction_summary'] = {
+            'prediction_id': job['prediction_id'],
+            'chat_id': job['chat_id'],
+            'original_img_path': str(first['original_img_path']),
+            'predicted_img_path': str(first['predicted_img_path']),
+            'labels': labels,
+            'time': time.time()
+        }
+
+        if len(job['photos']) > 1:
+            job['prediction_summary']['media_group_id'] = job['media_group_id']
+            job['prediction_summary']['images'] = [{
+                'original_img_path': str(photo['original_img_path']),
+                'predicted_img_path': str(photo['predicted_img_path']),
+                'counts': count_classes(photo['labels']),
+            } for photo in job['photos']]
+
+
+def upload_photo_results(job, photo):
+    prediction_id = job['prediction_id']
+    original_img_path = photo['original_img_path']
+
+    if 'cached' in photo:
+        # Duplicate photo: reuse the labels and the annotated image of the first prediction
+        labels = photo['cached']['labels']
+        predicted_img_path = photo['cached']['predicted_img_key']
+    else:
+        with telemetry.span('annotate', job['timings'], prediction_id):
+            predicted_img = detector.annotate(photo['image'], photo['detections'])
+        predicted_img_key = f'predicted_images/{prediction_id}/{original_img_path}'
+
+        # Upload the predicted image to S3 (do not override the original image)
+        with telemetry.span('upload', job['timings'], prediction_id):
+            if ZERO_DISK:
+                predicted_img_path = predicted_img_key
+                upload_image(predicted_img, predicted_img_key)
+            else:
+                # This is the path for the predicted image with labels
+                predicted_img_path = Path(f'static/data/{prediction_id}/{original_img_path.name}')
+                predicted_img_path.parent.mkdir(parents=True, exist_ok=True)
+                cv2.imwrite(str(predicted_img_path), predicted_img)
+                upload_to_s3(predicted_img_path, predicted_img_key)
+
+        # Create a summary from the prediction labels
+        labels = photo['detections'].labels()
+
+        if result_cache is not None and photo['photo_hash']:
+            result_cache.put(photo['photo_hash'], labels, predicted_img_key)
+
+    # The decoded image is not needed anymore, don't keep it alive in the next stages' queues
+    photo.pop('image', None)
+    photo['labels'] = labels
+    photo['predicted_img_path'] = predicted_img_path
+
+
+def store_results(job):
+    # Store the prediction_summary in a DynamoDB table, the write itself is batched by the result writer
+    if 'prediction_summary' in job:
+        job['store_started'] = time.perf_counter()
+        job['stored'] = store_in_dynamodb(job['prediction_summary'])
+
+
+def notify_jobs(jobs):
+    # Push the results of all the jobs to Polybot's /results endpoint in one POST request
+    notified = [job for job in jobs if 'prediction_summary' in job]
+    if not notified:
+        return
+
+    start = time.perf_counter()
+    failed = set(send_results_to_polybot([result_payload(job) for job in notified]))
+    elapsed = time.perf_counter() - start
+
+    for job in notified:
+        if job['prediction_id'] in failed:
+            # Not acked, the message is redelivered and the result pushed again
+            job['notify_failed'] = True
+            logger.error(f'prediction: {job["prediction_id"]}. Polybot could not deliver the result')
+            continue
+        telemetry.observe('polybot_notify', elapsed, job['timings'], job['prediction_id'])
+
+
+def result_payload(job):
+    """Everything Polybot needs to reply to the user, so it doesn't have to read the item back from DynamoDB"""
+    prediction_summary = job['prediction_summary']
+    payload = {
+        'prediction_id': prediction_summary['prediction_id'],
+        'chat_id': prediction_summary['chat_id'],
+        'counts': count_classes(prediction_summary['labels']),
+        # Lets Polybot measure the end-to-end latency, from photo received to result sent
+        'received_at': job['received_at'],
+    }
+    if 'images' in prediction_summary:
+        # Per-photo counts for the album reply
+        payload['images'] = [{'counts': image['counts']} for image in prediction_summary['images']]
+    return payload
+
+
+def ack_jobs(jobs):
+    # Only acknowledge the jobs whose results made it to DynamoDB and to the user, the others are retried
+    done = []
+    for job in jobs:
+        if job.get('notify_failed'):
+            continue
+        try:
+            if 'stored' in job:
+                written_at = job['stored'].result(timeout=DYNAMODB_STORE_TIMEOUT)
+                # Observed here rather than in a done-callback, which would run on the result writer's
+                # thread while this one may be logging the timings
+                telemetry.observe('dynamodb', written_at - job['store_started'], job['timings'],
+                                  job['prediction_id'])
+            done.append(job)
+        except Exception as e:
+            logger.error(f'prediction: {job["prediction_id"]}. Error storing in DynamoDB: {e}')
+
+    delete_messages(done)
+
+    for job in done:
+        telemetry.observe('worker_total', time.perf_counter() - job['started'], job['timings'], job['prediction_id'])
+        logger.info(f'prediction: {job["prediction_id"]}. timings: {json.dumps(job["timings"])}')
+
+
+def delete_messages(jobs):
+    if not jobs:
+        return
+
+    # One delete call per lane
+    by_queue = {}
+    for job in jobs:
+        by_queue.setdefault(job['queue_url'], []).append(job)
+
+    for queue_url, queue_jobs in by_queue.items():
+        entries = [{'Id': str(i), 'ReceiptHandle': job['receipt_handle']} for i, job in enumerate(queue_jobs)]
+        response = sqs_client.delete_message_batch(QueueUrl=queue_url, Entries=entries)
+
+        for failed in response.get('Failed', []):
+            logger.error(f'prediction: {queue_jobs[int(failed["Id"])]["prediction_id"]}. '
+                         f'Error deleting message: {failed.get("Message")}')
+
+
+def strip_photos_prefix(img_name):
+    # Remove 'photos/' prefix if it exists in img_name
+    return img_name[len('photos/'):] if img_name.startswith('photos/') else img_name
 
-            if pred_summary_path.exists():
-                labels = parse_labels(pred_summary_path)
-                logger.info(f'prediction: {prediction_id}/{original_img_path}. prediction summary:\n\n{labels}')
 
-                prediction_summary = {
-                    'prediction_id': prediction_id,
-                    'chat_id': chat_id,
-                    'original_img_path': str(original_img_path),
-                    'predicted_img_path': str(predicted_img_path),
-                    'labels': labels,
-                    'time': time.time()
-                }
+def download_image(img_name):
+    """Reads the S3 object into memory and decodes it, without going through the local disk"""
+    try:
+        data = aws.client('s3').get_object(Bucket=images_bucket, Key=strip_photos_prefix(img_name))['Body'].read()
+    except Exception as e:
+        logger.error(f'Error downloading image from S3: {e}')
+        raise
+
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise RuntimeError(f'Could not decode image {img_name}')
+    return image
 
-                # Store the prediction_summary in a DynamoDB table
-                store_in_dynamodb(prediction_summary)
 
-                # Perform a GET request to Polybot's /results endpoint
-                send_results_to_polybot(prediction_summary)
+def upload_image(image, s3_key):
+    """Encodes the image as JPEG in memory and uploads it"""
+    ok, encoded = cv2.imencode('.jpg', image)
+    if not ok:
+        raise RuntimeError(f'Could not encode image {s3_key}')
 
-            # Delete the message from the queue as the job is considered as DONE
-            sqs_client.delete_message(QueueUrl=queue_name, ReceiptHandle=receipt_handle)
+    try:
+        aws.client('s3').upload_fileobj(io.BytesIO(encoded.tobytes()), images_bucket, s3_key)
+    except Exception as e:
+        logger.error(f'Error uploading to S3: {e}')
+        raise
 
 
 def download_from_s3(img_name, prediction_id):
-    # Remove 'photos/' prefix if it exists in img_name
-    img_name_without_prefix = img_name[len('photos/'):] if img_name.startswith('photos/') else img_name
+    img_name_without_prefix = strip_photos_prefix(img_name)
     local_directory = Path("photos")
     local_directory.mkdir(parents=True, exist_ok=True)
     local_file_path = local_directory / f'{prediction_id}.jpg'
 
     try:
-        boto3.client('s3').download_file(images_bucket, img_name_without_prefix, str(local_file_path))
+        aws.client('s3').download_file(images_bucket, img_name_without_prefix, str(local_file_path))
     except Exception as e:
         logger.error(f'Error downloading image from S3: {e}')
         raise
@@ -139,7 +547,7 @@ def upload_to_s3(local_path, s3_key):
             return
 
         # Upload the file to S3
-        boto3.client('s3').upload_file(str(local_file_path), images_bucket, s3_key)
+        aws.client('s3').upload_file(str(local_file_path), images_bucket, s3_key)
 
         # Debug print
         print(f"After upload_to_s3: Local file exists: {local_file_path.exists()}")
@@ -148,21 +556,6 @@ def upload_to_s3(local_path, s3_key):
         raise
 
 
-def parse_labels(pred_summary_path):
-    with open(pred_summary_path) as f:
-        labels = f.read().splitlines()
-        labels = [line.split(' ') for line in labels]
-        labels = [{
-            'class': names[int(l[0])],
-            'cx': float(l[1]),
-            'cy': float(l[2]),
-            'width': float(l[3]),
-            'height': float(l[4]),
-        } for l in labels]
-
-    return labels
-
-
 def convert_floats_to_decimal(obj):
     if isinstance(obj, float):
         return Decimal(str(obj))
@@ -174,36 +567,94 @@ def convert_floats_to_decimal(obj):
 
 
 def store_in_dynamodb(prediction_summary):
+    """Queues the summary in the result writer, returns a Future that completes once it is written"""
     try:
-        prediction_summary = convert_floats_to_decimal(prediction_summary)
-        boto3.resource('dynamodb', region_name='eu-west-3').Table('ezdehar-table').put_item(Item=prediction_summary)
+        item = {key: value for key, value in prediction_summary.items() if key != 'labels'}
+        item.update(encode_labels(prediction_summary['labels'], LABEL_FORMAT))
+        return result_writer.put(convert_floats_to_decimal(item))
 
     except Exception as e:
         logger.error(f'Error storing in DynamoDB: {e}')
         raise
 
 
-def send_results_to_polybot(prediction_summary):
+def send_results_to_polybot(results):
+    """Returns the prediction_ids Polybot failed to deliver, when it delivered the others (207)"""
     try:
-        headers = {'Content-Type': 'application/json'}  # Add any other headers as needed
-        print("Request Headers:", headers)  # Add this line to print headers
-        pb_url = polybot_url + '/results/'
-        response = requests.get(polybot_url, params={'predictionId': prediction_summary['prediction_id']},
-                                headers=headers, verify=False)
+        # Keep-alive session, the ALB connection is reused across requests
+        response = polybot_session.post(polybot_url, json={'results': results}, verify=False)
         response.raise_for_status()
-        print(f"Response content: {response.content}")
-        # response.raise_for_status()
-        if response.status_code == 200:
-            logger.info("GET request to bot was successful.")
-            # logger.info("Response:", get_response.json())
-        else:
-            logger.info("GET request to bot failed.")
-            # logger.info("Status Code:", get_response.status_code)
+        logger.info(f'POST of {len(results)} results to bot was successful: {response.content}')
+        return response.json().get('failed', []) if response.status_code == 207 else []
 
     except requests.exceptions.RequestException as e:
         logger.error(f'Error sending results to Polybot: {e}')
         raise
 
 
+def setup():
+    """Reads the secrets (one Secrets Manager call) and creates the clients and the result writer"""
+    global images_bucket, queue_name, sqs_client, lane_poller, result_writer, result_cache
+    secrets = aws.get_secret('ezdehar-secret')
+
+    images_bucket = secrets['BUCKET_NAME']
+    queue_name = secrets['SQS_QUEUE_NAME']
+    sqs_client = aws.client('sqs')
+    lane_poller = LanePoller(sqs_client, parse_lanes(SQS_LANES, queue_name))
+
+    result_writer = ResultWriter(DYNAMODB_TABLE_NAME, max_items=DYNAMODB_BATCH_SIZE,
+                                 max_delay=DYNAMODB_FLUSH_INTERVAL)
+    if RESULT_CACHE:
+        result_cache = ResultCache(HASH_INDEX_TABLE_NAME, max_entries=RESULT_CACHE_SIZE)
+
+
+def readiness():
+    """/ready answers 200 once the model is loaded and warmed up, load balancers and ASG hooks can wait on it"""
+    if detector is None:
+        return 503, 'starting'
+    return 200, 'ready'
+
+
+def run_worker():
+    global detector
+    telemetry.configure('yolo5', emf=EMF)
+    # Served while the model loads, /ready tells when polling starts
+    telemetry.serve_metrics(METRICS_PORT + int(os.environ.get('WORKER_INDEX', 0)), routes={'/ready': readiness})
+
+    # Imports torch and yolov5, only the processes that run the model pay for it
+    from detector import Detector, backend_weights
+
+    setup()
+    if result_cache is not None:
+        telemetry.register_gauges('result_cache', result_cache.metrics)
+    telemetry.register_gauges('lanes', lane_poller.metrics)
+    telemetry.register_gauges('chats', chat_limiter.metrics)
+
+    # Warm up with the batch sizes the first messages are likely to come in
+    detector = Detector(weights=backend_weights(INFERENCE_BACKEND, 'yolov5s.pt'), data='data/coco128.yaml',
+                        warmup_batch_sizes=sorted({1, BATCH_SIZE}))
+
+    # From interpreter start (or process spawn) to ready to poll
+    startup = time.time() - STARTED_AT
+    telemetry.observe('startup', startup)
+    logger.info(f'Worker ready in {startup:.2f}s')
+
+    if PIPELINE:
+        consume_pipelined()
+    else:
+        consume()
+
+
 if __name__ == "__main__":
-    consume()
+    if INFERENCE_BACKEND != 'torch':
+        # Export once here, not concurrently in every worker process. The torch backend needs no export,
+        # so the supervisor doesn't import torch for it
+        from detector import backend_weights
+        backend_weights(INFERENCE_BACKEND, 'yolov5s.pt')
+
+    core_sets = plan_workers(WORKERS, THREADS_PER_WORKER)
+
+    if len(core_sets) > 1:
+        run_supervisor(run_worker, core_sets)
+    else:
+        run_worker()
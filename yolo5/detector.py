@@ -0,0 +1,148 @@
+from pathlib import Path
+
+import numpy as np
+import torch
+from loguru import logger
+from models.common import DetectMultiBackend
+from utils.augmentations import letterbox
+from utils.general import check_img_size, non_max_suppression, scale_boxes
+from utils.plots import Annotator, colors
+from utils.torch_utils import select_device
+
+
+BACKENDS = ('torch', 'onnx', 'onnx-int8')
+
+
+def export_onnx(weights='yolov5s.pt', imgsz=640, int8=False):
+    """
+    Exports the PyTorch weights to ONNX (dynamic batch size) with yolov5's export.py, and optionally
+    quantizes the weights to int8 with ONNX Runtime's dynamic quantization. Existing files are reused.
+    :return: path to the .onnx file
+    """
+    onnx_path = Path(weights).with_suffix('.onnx')
+    if not onnx_path.exists():
+        import export
+        export.run(weights=weights, imgsz=(imgsz, imgsz), include=('onnx',), dynamic=True)
+
+    if not int8:
+        return str(onnx_path)
+
+    int8_path = onnx_path.with_name(f'{onnx_path.stem}-int8.onnx')
+    if not int8_path.exists():
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(str(onnx_path), str(int8_path), weight_type=QuantType.QUInt8)
+    return str(int8_path)
+
+
+def backend_weights(backend, weights='yolov5s.pt', imgsz=640):
+    """Weights file for the inference backend, DetectMultiBackend picks the runtime from its suffix"""
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown inference backend {backend!r}, expected one of {BACKENDS}')
+    if backend == 'torch':
+        return weights
+    return export_onnx(weights, imgsz=imgsz, int8=backend == 'onnx-int8')
+
+
+class Detections:
+    """Detections for a single image, in original image pixel coordinates"""
+
+    def __init__(self, boxes, confidences, class_ids, names, shape):
+        self.boxes = boxes  # (n, 4) xyxy
+        self.confidences = confidences  # (n,)
+        self.class_ids = class_ids  # (n,)
+        self.names = names
+        self.shape = shape  # (h, w) of the original image
+
+    def __len__(self):
+        return len(self.class_ids)
+
+    @property
+    def classes(self):
+        return [self.names[int(c)] for c in self.class_ids]
+
+    def labels(self):
+        """Same structure as the normalized xywh label files written by detect.py with save_txt=True"""
+        h, w = self.shape
+        labels = []
+        for (x1, y1, x2, y2), class_id in zip(self.boxes.tolist(), self.class_ids.tolist()):
+            labels.append({
+                'class': self.names[int(class_id)],
+                'cx': ((x1 + x2) / 2) / w,
+                'cy': ((y1 + y2) / 2) / h,
+                'width': (x2 - x1) / w,
+                'height': (y2 - y1) / h,
+            })
+        return labels
+
+
+class Detector:
+    """
+    Long-lived YOLOv5 model. Weights are loaded and the model is warmed up once, at construction time,
+    so every following predict() call only pays for the forward pass and NMS.
+
+    The weights can be a .pt file (PyTorch) or a .onnx file (ONNX Runtime, see backend_weights()).
+    Pre-processing, NMS and post-processing are the same for every backend.
+    """
+
+    def __init__(self, weights='yolov5s.pt', data='data/coco128.yaml', imgsz=640, conf_thres=0.25, iou_thres=0.45,
+                 max_det=1000, device='', warmup_batch_sizes=(1,)):
+        self.device = select_device(device)
+        self.model = DetectMultiBackend(weights, device=self.device, data=data)
+        self.stride = self.model.stride
+        self.names = self.model.names
+        self.imgsz = check_img_size(imgsz, s=self.stride)
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.max_det = max_det
+
+        # DetectMultiBackend.warmup() does nothing on CPU. A full dummy prediction per batch size pays for
+        # the lazy allocations and kernel selection here, instead of on the first real messages
+        for batch_size in warmup_batch_sizes:
+            self.predict_batch([np.zeros((self.imgsz, self.imgsz, 3), dtype=np.uint8)] * batch_size)
+        logger.info(f'Detector ready: weights={weights}, imgsz={self.imgsz}, device={self.device}')
+
+    def preprocess(self, image, auto=None):
+        """BGR HWC uint8 image -> CHW RGB contiguous array, letterboxed to the model input size"""
+        auto = self.model.pt if auto is None else auto
+        im = letterbox(image, self.imgsz, stride=self.stride, auto=auto)[0]
+        im = im.transpose((2, 0, 1))[::-1]
+        return np.ascontiguousarray(im)
+
+    @torch.no_grad()
+    def predict(self, image):
+        im = self._to_tensor(self.preprocess(image)[None])
+        det = self._infer(im)[0]
+        return self._to_detections(det, im.shape[2:], image.shape[:2])
+
+    @torch.no_grad()
+    def predict_batch(self, images):
+        """
+        Runs one forward pass over all the images. Every image is letterboxed to the full square input size
+        (no minimal-rectangle padding) so they all stack into a single tensor.
+        """
+        im = self._to_tensor(np.stack([self.preprocess(image, auto=False) for image in images]))
+        dets = self._infer(im)
+        return [self._to_detections(det, im.shape[2:], image.shape[:2]) for det, image in zip(dets, images)]
+
+    def _to_tensor(self, ims):
+        im = torch.from_numpy(ims).to(self.model.device)
+        im = im.half() if self.model.fp16 else im.float()
+        im /= 255
+        return im
+
+    def _infer(self, im):
+        pred = self.model(im)
+        return non_max_suppression(pred, self.conf_thres, self.iou_thres, max_det=self.max_det)
+
+    def _to_detections(self, det, input_shape, image_shape):
+        if len(det):
+            det[:, :4] = scale_boxes(input_shape, det[:, :4], image_shape).round()
+        det = det.cpu().numpy()
+        return Detections(det[:, :4], det[:, 4], det[:, 5].astype(int), self.names, image_shape)
+
+    def annotate(self, image, detections, line_width=3):
+        """Draws the detections onto a copy of the image, the same way detect.py does for saved images"""
+        annotator = Annotator(image.copy(), line_width=line_width, example=str(self.names))
+        for box, conf, class_id in zip(detections.boxes, detections.confidences, detections.class_ids):
+            annotator.box_label(box, f'{self.names[int(class_id)]} {conf:.2f}', color=colors(int(class_id), True))
+        return annotator.result()
@@ -0,0 +1,81 @@
+"""
+Encodings of the prediction labels stored in DynamoDB.
+
+    legacy    'labels' is a list of {'class', 'cx', 'cy', 'width', 'height'} maps, one Decimal per coordinate
+    columnar  'labels' is a map of parallel lists: {'class': [...], 'cx': [...], 'cy': [...], ...}
+    packed    'labels' is a binary attribute, LABEL_STRUCT per label with the coordinates quantized to
+              uint16, and 'class_names' holds the names the class indexes refer to
+
+Every format also stores 'counts', the number of objects per class, so readers that only need the
+summary don't have to decode the labels at all.
+"""
+import struct
+from decimal import Decimal
+
+LABEL_FORMATS = ('legacy', 'columnar', 'packed')
+COORDINATES = ('cx', 'cy', 'width', 'height')
+
+# class index, cx, cy, width, height
+LABEL_STRUCT = struct.Struct('<B4H')
+QUANTIZATION_SCALE = 65535
+
+
+def count_classes(labels):
+    counts = {}
+    for label in labels:
+        counts[label['class']] = counts.get(label['class'], 0) + 1
+    return counts
+
+
+def encode_labels(labels, label_format='legacy'):
+    """Returns the item attributes holding the labels in the given format"""
+    if label_format not in LABEL_FORMATS:
+        raise ValueError(f'Unknown label format {label_format!r}, expected one of {LABEL_FORMATS}')
+
+    attributes = {'counts': count_classes(labels)}
+
+    if label_format == 'legacy':
+        attributes['labels'] = [
+            {'class': label['class'], **{c: Decimal(str(label[c])) for c in COORDINATES}} for label in labels
+        ]
+    elif label_format == 'columnar':
+        attributes['label_format'] = 'columnar'
+        attributes['labels'] = {
+            'class': [label['class'] for label in labels],
+            **{c: [Decimal(f'{label[c]:.4f}') for label in labels] for c in COORDINATES},
+        }
+    else:
+        class_names = list(attributes['counts'])
+        class_index = {name: i for i, name in enumerate(class_names)}
+        attributes['label_format'] = 'packed'
+        attributes['class_names'] = class_names
+        attributes['labels'] = b''.join(
+            LABEL_STRUCT.pack(class_index[label['class']], *(_quantize(label[c]) for c in COORDINATES))
+            for label in labels
+        )
+
+    return attributes
+
+
+def decode_labels(item):
+    """Returns the labels of a stored item as a legacy list of maps, whatever format they were stored in"""
+    label_format = item.get('label_format', 'legacy')
+    labels = item.get('labels', [])
+
+    if label_format == 'columnar':
+        return [
+            {'class': name, **{c: float(labels[c][i]) for c in COORDINATES}}
+            for i, name in enumerate(labels['class'])
+        ]
+    if label_format == 'packed':
+        class_names = item['class_names']
+        packed = getattr(labels, 'value', labels)  # boto3 returns binary attributes as Binary
+        return [
+            {'class': class_names[values[0]], **{c: v / QUANTIZATION_SCALE for c, v in zip(COORDINATES, values[1:])}}
+            for values in LABEL_STRUCT.iter_unpack(bytes(packed))
+        ]
+    return labels
+
+
+def _quantize(value):
+    return min(max(round(value * QUANTIZATION_SCALE), 0), QUANTIZATION_SCALE)
@@ -0,0 +1,119 @@
+import threading
+
+
+class Lane:
+
+    def __init__(self, name, queue_url, weight=1):
+        self.name = name
+        self.queue_url = queue_url
+        self.weight = weight
+        self.current = 0  # smooth weighted round-robin state
+        self.received = 0
+
+
+def parse_lanes(spec, default_queue):
+    """
+    'interactive=<queue url>:4,bulk=<queue url>:1' -> lanes polled 4:1. The weight defaults to 1.
+    An empty spec is a single lane on the default queue.
+    """
+    lanes = []
+    for entry in filter(None, (entry.strip() for entry in spec.split(','))):
+        name, _, queue_url = entry.partition('=')
+        queue_url, _, weight = queue_url.rpartition(':')
+        if not weight.isdigit():
+            # No weight, the colon belongs to the URL
+            queue_url, weight = f'{queue_url}:{weight}' if queue_url else weight, '1'
+        lanes.append(Lane(name.strip(), queue_url, int(weight)))
+    return lanes or [Lane('default', default_queue)]
+
+
+class LanePoller:
+    """
+    Receives from several SQS queues (lanes) with smooth weighted round-robin: with weights 4 and 1, four
+    receive calls out of five go to the first lane first. The batch is topped up from the other lanes,
+    so capacity is never left idle while any lane has messages.
+
+    With several lanes, queues are polled without waiting and only an idle round long polls, for at most
+    idle_wait seconds, so a quiet lane doesn't delay the others.
+    """
+
+    def __init__(self, sqs_client, lanes, idle_wait=1):
+        self.sqs_client = sqs_client
+        self.lanes = lanes
+        self.idle_wait = idle_wait
+        self._lock = threading.Lock()
+
+    def receive(self, max_messages, wait_time):
+        """Messages from the lanes, each with the QueueUrl and Lane it came from"""
+        lanes = self._order()
+        single = len(lanes) == 1
+        messages = []
+
+        for lane in lanes:
+            if len(messages) >= max_messages:
+                break
+            messages += self._receive(lane, max_messages - len(messages), wait_time if single else 0)
+
+        if not messages and not single and wait_time:
+            messages = self._receive(lanes[0], max_messages, min(wait_time, self.idle_wait))
+        return messages
+
+    def metrics(self):
+        return {f'{lane.name}_received': lane.received for lane in self.lanes}
+
+    def _order(self):
+        """The lane whose turn it is, then the others by decreasing weight"""
+        with self._lock:
+            total = sum(lane.weight for lane in self.lanes)
+            for lane in self.lanes:
+                lane.current += lane.weight
+            first = max(self.lanes, key=lambda lane: lane.current)
+            first.current -= total
+        return [first] + sorted((lane for lane in self.lanes if lane is not first), key=lambda lane: -lane.weight)
+
+    def _receive(self, lane, max_messages, wait_time):
+        response = self.sqs_client.receive_message(QueueUrl=lane.queue_url, MaxNumberOfMessages=max_messages,
+                                                   WaitTimeSeconds=wait_time, AttributeNames=['SentTimestamp'])
+        messages = response.get('Messages', [])
+        for message in messages:
+            message['QueueUrl'] = lane.queue_url
+            message['Lane'] = lane.name
+        with self._lock:
+            lane.received += len(messages)
+        return messages
+
+
+class ChatLimiter:
+    """Caps the jobs of one chat in flight at the same time, so a chat flooding photos can't take all the slots"""
+
+    def __init__(self, max_per_chat):
+        self.max_per_chat = max_per_chat
+        self._in_flight = {}
+        self._deferred = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, chat_id):
+        """Takes a slot for the chat, False (and counted as deferred) when the chat is at its cap"""
+        if not self.max_per_chat or chat_id is None:
+            return True
+        with self._lock:
+            if self._in_flight.get(chat_id, 0) >= self.max_per_chat:
+                self._deferred += 1
+                return False
+            self._in_flight[chat_id] = self._in_flight.get(chat_id, 0) + 1
+            return True
+
+    def release(self, chat_id):
+        if not self.max_per_chat or chat_id is None:
+            return
+        with self._lock:
+            remaining = self._in_flight.get(chat_id, 0) - 1
+            if remaining > 0:
+                self._in_flight[chat_id] = remaining
+            else:
+                self._in_flight.pop(chat_id, None)
+
+    def metrics(self):
+        with self._lock:
+            return {'chats_in_flight': len(self._in_flight), 'jobs_in_flight': sum(self._in_flight.values()),
+                    'deferred': self._deferred}
@@ -0,0 +1,99 @@
+"""
+Accuracy-parity check of an inference backend against the PyTorch one, on a fixed set of images.
+
+    python3 parity_check.py --images data/images --backend onnx-int8
+
+Detections of both backends are matched greedily by class and IoU. The check fails (exit code 1) when
+less than --min-recall of the PyTorch detections are found by the backend, or when the backend adds
+more than --max-extra unmatched detections per image on average.
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from detector import BACKENDS, Detector, backend_weights
+
+
+def box_iou(box, boxes):
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[2], boxes[:, 2])
+    y2 = np.minimum(box[3], boxes[:, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return inter / (area + areas - inter + 1e-9)
+
+
+def match(reference, candidate, iou_thres):
+    """Returns the number of reference detections matched by a candidate detection of the same class"""
+    used = np.zeros(len(candidate), dtype=bool)
+    matched = 0
+    for box, class_id in zip(reference.boxes, reference.class_ids):
+        if not len(candidate):
+            break
+        ious = box_iou(box, candidate.boxes)
+        ious[(candidate.class_ids != class_id) | used] = 0
+        best = int(ious.argmax())
+        if ious[best] >= iou_thres:
+            used[best] = True
+            matched += 1
+    return matched
+
+
+def timed_predict(detector, image):
+    start = time.perf_counter()
+    detections = detector.predict(image)
+    return detections, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', default='data/images', help='directory of the fixed image set')
+    parser.add_argument('--backend', default='onnx-int8', choices=BACKENDS[1:])
+    parser.add_argument('--weights', default='yolov5s.pt')
+    parser.add_argument('--iou', type=float, default=0.5)
+    parser.add_argument('--min-recall', type=float, default=0.95)
+    parser.add_argument('--max-extra', type=float, default=0.5)
+    args = parser.parse_args()
+
+    image_paths = sorted(p for p in Path(args.images).iterdir() if p.suffix.lower() in ('.jpg', '.jpeg', '.png'))
+    if not image_paths:
+        sys.exit(f'No images found in {args.images}')
+
+    reference_detector = Detector(weights=args.weights)
+    backend_detector = Detector(weights=backend_weights(args.backend, args.weights))
+
+    reference_total = backend_total = matched_total = 0
+    reference_time = backend_time = 0.0
+    for path in image_paths:
+        image = cv2.imread(str(path))
+        reference, reference_seconds = timed_predict(reference_detector, image)
+        candidate, backend_seconds = timed_predict(backend_detector, image)
+
+        matched = match(reference, candidate, args.iou)
+        reference_total += len(reference)
+        backend_total += len(candidate)
+        matched_total += matched
+        reference_time += reference_seconds
+        backend_time += backend_seconds
+        print(f'{path.name}: torch {len(reference)}, {args.backend} {len(candidate)}, matched {matched}')
+
+    recall = matched_total / reference_total if reference_total else 1.0
+    extra_per_image = (backend_total - matched_total) / len(image_paths)
+    print(f'\n{len(image_paths)} images, recall {recall:.3f}, extra detections per image {extra_per_image:.2f}')
+    print(f'mean latency: torch {1000 * reference_time / len(image_paths):.1f}ms, '
+          f'{args.backend} {1000 * backend_time / len(image_paths):.1f}ms')
+
+    if recall < args.min_recall or extra_per_image > args.max_extra:
+        print('Parity check FAILED')
+        sys.exit(1)
+    print('Parity check passed')
+
+
+if __name__ == '__main__':
+    main()
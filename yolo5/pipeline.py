@@ -0,0 +1,134 @@
+import queue
+import threading
+from loguru import logger
+
+
+class InFlightLimiter:
+    """Counts the jobs between receive and ack, and blocks the poller once `limit` jobs are in flight"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, wanted):
+        """Blocks until at least one slot is free, then takes up to `wanted` slots and returns how many were taken"""
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            granted = min(wanted, self.limit - self.in_flight)
+            self.in_flight += granted
+            return granted
+
+    def release(self, n=1):
+        if n <= 0:
+            return
+        with self._cond:
+            self.in_flight -= n
+            self._cond.notify_all()
+
+
+class Stage:
+    """
+    One step of the pipeline, served by `workers` threads.
+    With batch_size=None, fn is called with a single job. Otherwise fn is called with a list of up to
+    batch_size jobs that were waiting in the stage queue.
+    """
+
+    def __init__(self, name, fn, workers=1, batch_size=None):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.batch_size = batch_size
+
+
+class Pipeline:
+    """
+    Runs jobs through a chain of stages connected by bounded queues, so network stages keep working
+    while the inference stage is busy, e.g.:
+
+        poller -> download (S3 pool) -> inference -> upload (S3 pool) -> DynamoDB pool -> Polybot pool -> ack
+
+    A job that raises in a stage is dropped from the pipeline without being acked, so its SQS message
+    is retried after the visibility timeout. on_done(job) is called for every job leaving the pipeline,
+    dropped or through the last stage.
+    """
+
+    def __init__(self, receive, stages, max_in_flight=32, max_receive=10, on_done=None):
+        self.receive = receive  # receive(max_messages) -> list of jobs
+        self.stages = stages
+        self.on_done = on_done
+        self.max_receive = max_receive
+        self.limiter = InFlightLimiter(max_in_flight)
+        self.queues = [queue.Queue(maxsize=max_in_flight) for _ in stages]
+
+    def run(self):
+        for index, stage in enumerate(self.stages):
+            for n in range(stage.workers):
+                threading.Thread(target=self._work, args=(index,), name=f'{stage.name}-{n}', daemon=True).start()
+
+        while True:
+            granted = self.limiter.acquire(self.max_receive)
+            try:
+                jobs = self.receive(granted)
+            except Exception as e:
+                logger.error(f'Error receiving jobs: {e}')
+                jobs = []
+
+            self.limiter.release(granted - len(jobs))
+            for job in jobs:
+                self.queues[0].put(job)
+
+    def _work(self, index):
+        stage = self.stages[index]
+        inbox = self.queues[index]
+        outbox = self.queues[index + 1] if index + 1 < len(self.stages) else None
+
+        while True:
+            jobs = self._take(inbox, stage.batch_size or 1)
+
+            if stage.batch_size:
+                try:
+                    stage.fn(jobs)
+                    passed = jobs
+                except Exception as e:
+                    logger.error(f'Stage {stage.name} failed for {len(jobs)} jobs: {e}')
+                    passed = []
+            else:
+                passed = []
+                for job in jobs:
+                    try:
+                        stage.fn(job)
+                        passed.append(job)
+                    except Exception as e:
+                        logger.error(f'Stage {stage.name} failed for prediction {job.get("prediction_id")}: {e}')
+
+            self.limiter.release(len(jobs) - len(passed))
+            if outbox is None:
+                self.limiter.release(len(passed))
+                self._done(jobs)
+            else:
+                passed_ids = {id(job) for job in passed}
+                self._done([job for job in jobs if id(job) not in passed_ids])
+                for job in passed:
+                    outbox.put(job)
+
+    def _done(self, jobs):
+        if self.on_done is None:
+            return
+        for job in jobs:
+            try:
+                self.on_done(job)
+            except Exception as e:
+                logger.error(f'on_done failed for prediction {job.get("prediction_id")}: {e}')
+
+    @staticmethod
+    def _take(inbox, max_items):
+        """Blocks for the first job, then takes whatever else is already waiting, up to max_items"""
+        jobs = [inbox.get()]
+        while len(jobs) < max_items:
+            try:
+                jobs.append(inbox.get_nowait())
+            except queue.Empty:
+                break
+        return jobs
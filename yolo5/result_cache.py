@@ -0,0 +1,81 @@
+import json
+import threading
+from collections import OrderedDict
+from loguru import logger
+
+import aws
+
+
+class ResultCache:
+    """
+    Content-addressed cache of prediction results, keyed by the SHA-256 of the original photo.
+
+    An in-process LRU of `max_entries` results sits in front of a DynamoDB table (partition key
+    `photo_hash`) shared by all the workers. A cached result holds the labels and the S3 key of the
+    annotated image, which is all a duplicate photo needs to skip download, inference and upload.
+    """
+
+    def __init__(self, table_name, max_entries=10000):
+        self.table_name = table_name
+        self.max_entries = max_entries
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {'memory_hits': 0, 'dynamodb_hits': 0, 'misses': 0, 'errors': 0}
+
+    def get(self, photo_hash):
+        with self._lock:
+            result = self._entries.get(photo_hash)
+            if result is not None:
+                self._entries.move_to_end(photo_hash)
+                self._counters['memory_hits'] += 1
+                return result
+
+        try:
+            item = aws.table(self.table_name).get_item(Key={'photo_hash': photo_hash}).get('Item')
+        except Exception as e:
+            # The cache is an optimization only, a failed lookup is a miss
+            logger.error(f'Error reading result cache for {photo_hash}: {e}')
+            self._count('errors')
+            item = None
+
+        if item is None:
+            self._count('misses')
+            return None
+
+        result = {'labels': json.loads(item['labels']), 'predicted_img_key': item['predicted_img_key']}
+        self._remember(photo_hash, result)
+        self._count('dynamodb_hits')
+        return result
+
+    def put(self, photo_hash, labels, predicted_img_key):
+        result = {'labels': labels, 'predicted_img_key': predicted_img_key}
+        self._remember(photo_hash, result)
+
+        try:
+            # The labels are stored as a JSON string, they are only ever read back as a whole
+            aws.table(self.table_name).put_item(Item={
+                'photo_hash': photo_hash,
+                'labels': json.dumps(labels),
+                'predicted_img_key': predicted_img_key,
+            })
+        except Exception as e:
+            logger.error(f'Error writing result cache for {photo_hash}: {e}')
+            self._count('errors')
+
+    def metrics(self):
+        with self._lock:
+            hits = self._counters['memory_hits'] + self._counters['dynamodb_hits']
+            lookups = hits + self._counters['misses']
+            return {**self._counters, 'entries': len(self._entries), 'hit_ratio': hits / lookups if lookups else 0.0}
+
+    def _remember(self, photo_hash, result):
+        with self._lock:
+            self._entries[photo_hash] = result
+            self._entries.move_to_end(photo_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
@@ -0,0 +1,112 @@
+import threading
+import time
+from concurrent.futures import Future
+
+from boto3.dynamodb.types import TypeSerializer
+from loguru import logger
+
+import aws
+import telemetry
+
+# BatchWriteItem accepts at most 25 put requests
+MAX_BATCH_ITEMS = 25
+
+
+class ResultWriter:
+    """
+    Buffers DynamoDB items and writes them with BatchWriteItem. The buffer is flushed as soon as it holds
+    max_items items, or max_delay seconds after the oldest buffered item was added.
+
+    put() returns a Future that completes once the item is written, so callers that need the item to
+    be readable (e.g. before notifying Polybot) can wait for it without forcing a flush per item.
+    Its result is the time.perf_counter() of the write, for the caller to time the put on its own thread.
+    """
+
+    def __init__(self, table_name, max_items=MAX_BATCH_ITEMS, max_delay=0.5, max_retries=5):
+        self.table_name = table_name
+        self.max_items = min(max_items, MAX_BATCH_ITEMS)
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+
+        self._serializer = TypeSerializer()
+        self._buffer = []  # (put request, future)
+        self._oldest = None
+        self._cond = threading.Condition()
+        threading.Thread(target=self._flush_loop, name='result-writer', daemon=True).start()
+
+    def put(self, item):
+        request = {'PutRequest': {'Item': {k: self._serializer.serialize(v) for k, v in item.items()}}}
+        future = Future()
+
+        with self._cond:
+            if not self._buffer:
+                self._oldest = time.time()
+            self._buffer.append((request, future))
+            # The first buffered item starts the max_delay countdown, a full buffer is written right away
+            if len(self._buffer) == 1 or len(self._buffer) >= self.max_items:
+                self._cond.notify()
+        return future
+
+    def flush(self):
+        """Writes everything that is buffered right now, blocking until it is written"""
+        with self._cond:
+            batch, self._buffer, self._oldest = self._buffer, [], None
+        for i in range(0, len(batch), self.max_items):
+            self._write(batch[i:i + self.max_items])
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                while not self._buffer:
+                    self._cond.wait()
+                while self._buffer and len(self._buffer) < self.max_items:
+                    remaining = self._oldest + self.max_delay - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._buffer = self._buffer[:self.max_items], self._buffer[self.max_items:]
+                self._oldest = time.time() if self._buffer else None
+
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        # BatchWriteItem rejects two requests for the same key, e.g. a message delivered twice: the last
+        # put is written, and the futures of all of them complete with it
+        pending = {}
+        for request, future in batch:
+            key = _item_key(request)
+            futures = pending[key][1] if key in pending else []
+            pending[key] = (request, futures + [future])
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                with telemetry.span('dynamodb_batch_write'):
+                    response = aws.client('dynamodb').batch_write_item(
+                        RequestItems={self.table_name: [request for request, _ in pending.values()]}
+                    )
+                unprocessed = {_item_key(request) for request in
+                               response.get('UnprocessedItems', {}).get(self.table_name, [])}
+            except Exception as e:
+                logger.error(f'Error writing {len(pending)} items to DynamoDB: {e}')
+                unprocessed = set(pending)
+
+            written_at = time.perf_counter()
+            for key in set(pending) - unprocessed:
+                for future in pending.pop(key)[1]:
+                    future.set_result(written_at)
+
+            if not pending:
+                return
+
+            # Exponential backoff before retrying the throttled or failed items
+            time.sleep(min(0.05 * 2 ** attempt, 2))
+
+        logger.error(f'Giving up on {len(pending)} DynamoDB items after {self.max_retries} retries')
+        for _, futures in pending.values():
+            for future in futures:
+                future.set_exception(RuntimeError('DynamoDB BatchWriteItem retries exhausted'))
+
+
+def _item_key(request):
+    return request['PutRequest']['Item']['prediction_id']['S']
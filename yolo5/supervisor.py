@@ -0,0 +1,63 @@
+import multiprocessing
+import os
+import time
+from loguru import logger
+
+
+def plan_workers(workers='auto', threads_per_worker=2):
+    """
+    Splits the CPUs available to this process between model replicas.
+    :param workers: number of replicas, or 'auto' for one replica per `threads_per_worker` cores
+    :return: the list of core sets, one per replica
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    threads_per_worker = max(1, min(threads_per_worker, len(cores)))
+
+    if workers == 'auto':
+        workers = max(1, len(cores) // threads_per_worker)
+    workers = int(workers)
+
+    # With more replicas than core sets, replicas share cores round-robin
+    return [[cores[(i * threads_per_worker + j) % len(cores)] for j in range(threads_per_worker)]
+            for i in range(workers)]
+
+
+def run_supervisor(target, core_sets):
+    """
+    Runs target() in one process per core set and restarts processes that die. Every process pins itself
+    to its cores and sizes torch's thread pools to match, so replicas don't fight over intra-op threads.
+    The processes poll the same SQS queue independently.
+    """
+    context = multiprocessing.get_context('spawn')
+    processes = [None] * len(core_sets)
+    logger.info(f'Starting {len(core_sets)} worker processes on cores {core_sets}')
+
+    while True:
+        for i, cores in enumerate(core_sets):
+            process = processes[i]
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                logger.error(f'Worker process {i} exited with code {process.exitcode}, restarting it')
+
+            # Read by torch/OpenMP when the spawned interpreter imports them
+            os.environ['OMP_NUM_THREADS'] = str(len(cores))
+            os.environ['MKL_NUM_THREADS'] = str(len(cores))
+            # Lets the worker pick its own metrics port
+            os.environ['WORKER_INDEX'] = str(i)
+
+            process = context.Process(target=_worker_main, args=(target, cores), name=f'yolo5-worker-{i}', daemon=True)
+            process.start()
+            processes[i] = process
+
+        time.sleep(1)
+
+
+def _worker_main(target, cores):
+    import torch
+
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    torch.set_num_interop_threads(1)
+    logger.info(f'Worker process {os.getpid()} pinned to cores {cores}')
+    target()
@@ -0,0 +1,172 @@
+"""
+Low-overhead latency instrumentation.
+
+Every stage timing goes into an in-process histogram with fixed buckets (a bisect and two additions
+under a lock), exposed in Prometheus text format by serve_metrics(). With emf=True each observation
+is also printed as a CloudWatch Embedded Metric Format line, which the CloudWatch agent turns into
+metrics.
+"""
+import bisect
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, math.inf)
+EMF_NAMESPACE = 'YoloBotEMetrics'
+
+_service = 'app'
+_emf = False
+_histograms = {}
+_lock = threading.Lock()
+_gauges = {}  # name -> function returning a {metric: value} dict
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile"""
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = q * self.count
+            cumulative = 0
+            for bound, count in zip(BUCKETS, self.counts):
+                cumulative += count
+                if cumulative >= rank:
+                    return bound
+        return BUCKETS[-1]
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+def configure(service, emf=False):
+    global _service, _emf
+    _service = service
+    _emf = emf
+
+
+def histogram(stage):
+    stage_histogram = _histograms.get(stage)
+    if stage_histogram is None:
+        with _lock:
+            stage_histogram = _histograms.setdefault(stage, Histogram())
+    return stage_histogram
+
+
+def observe(stage, seconds, timings=None, prediction_id=None):
+    """Records a stage duration, and in `timings` (the per-prediction span dict) when given"""
+    histogram(stage).observe(seconds)
+    if timings is not None:
+        timings[stage] = round(seconds, 4)
+    if _emf:
+        _emit_emf(stage, seconds, prediction_id)
+
+
+@contextmanager
+def span(stage, timings=None, prediction_id=None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, timings, prediction_id)
+
+
+def register_gauges(name, fn):
+    """fn() returns a {metric: number} dict, read every time the metrics are exposed"""
+    _gauges[name] = fn
+
+
+def snapshot():
+    return {
+        'latency': {stage: h.snapshot() for stage, h in sorted(_histograms.items())},
+        **{name: fn() for name, fn in _gauges.items()},
+    }
+
+
+def prometheus_text():
+    lines = []
+    for stage, h in sorted(_histograms.items()):
+        labels = f'service="{_service}",stage="{stage}"'
+        cumulative = 0
+        for bound, count in zip(BUCKETS, list(h.counts)):
+            cumulative += count
+            le = '+Inf' if bound == math.inf else bound
+            lines.append(f'stage_latency_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f'stage_latency_seconds_sum{{{labels}}} {h.sum}')
+        lines.append(f'stage_latency_seconds_count{{{labels}}} {h.count}')
+
+    for name, fn in _gauges.items():
+        for metric, value in fn().items():
+            if isinstance(value, (int, float)):
+                lines.append(f'{name}_{metric}{{service="{_service}"}} {float(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(port, routes=None):
+    """
+    Serves /metrics (Prometheus text) and /metrics.json on a background thread.
+    :param routes: extra {path: fn} routes, fn() returns (status code, text)
+    """
+    routes = {
+        '/metrics': lambda: (200, prometheus_text()),
+        '/metrics.json': lambda: (200, json.dumps(snapshot())),
+        **(routes or {}),
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            route = routes.get(self.path.rstrip('/') or '/')
+            status, body = route() if route else (404, 'Not found')
+            data = body.encode()
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+
+def _emit_emf(stage, seconds, prediction_id):
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': EMF_NAMESPACE,
+                'Dimensions': [['Service', 'Stage']],
+                'Metrics': [{'Name': 'Latency', 'Unit': 'Milliseconds'}],
+            }],
+        },
+        'Service': _service,
+        'Stage': stage,
+        'Latency': seconds * 1000,
+        'prediction_id': prediction_id,
+    }), flush=True)